@@ -1,39 +1,74 @@
-
 import pretty_midi
+import numpy as np
+import argparse
 import csv
 import os
-import copy
 import wave
+from multiprocessing import Pool
 from util import *
 
-# get the list of midfiles and csvfiles
-path = 'MIDI/'
-midfiles = []
-csvfiles = []
-for file in os.listdir(path):
-    if file.endswith('.mid'): midfiles.append(path+file)
-    if file.endswith('.csv'): csvfiles.append(path+file)
-midfiles.sort()
-csvfiles.sort()
-
-# record the key and mode in csvfiles
-bars = []
-for csvfile in csvfiles:
-    with open(csvfile, 'rb') as file:
-        reader = csv.reader(file, delimiter=',')
-        rows = iter(reader)
-        next(rows)
-        for row in rows:
-            bars.append(int(row[-1]))
-
 new_path = ['MIDI_sep/melody/', 'MIDI_sep/chord/', 'MIDI_sep/root/']
-for i in range(len(midfiles)):
-    if bars[i] > 8: continue
-    midi = pretty_midi.PrettyMIDI(midfiles[i]) # load MIDI file
-    for k in range(len(midi.instruments)):
-        midi_sep = copy.deepcopy(midi)
-        midi_sep.instruments[0] = midi_sep.instruments[k]
-        del midi_sep.instruments[1:3]
-        midi_sep.write(new_path[k]+str(i)+'.mid')
-        audio = midi.synthesize()
 
+
+def write_wav(audio, path, fs=44100):
+    audio = np.int16(audio / max(np.max(np.abs(audio)), 1e-9) * 32767)
+    out = wave.open(path, 'wb')
+    out.setnchannels(1)
+    out.setsampwidth(2)
+    out.setframerate(fs)
+    out.writeframes(audio.tostring())
+    out.close()
+
+
+def separate(job):
+    """
+    Write each instrument of a MIDI file to its own MIDI file.
+    The instruments are swapped in and out of the parsed file instead of copying it once per instrument
+
+    :param job: (index of the song, path of the MIDI file, whether to render audio too)
+    """
+    i, midfile, audio = job
+    midi = pretty_midi.PrettyMIDI(midfile)  # load MIDI file
+    instruments = midi.instruments
+    for instrument, directory in zip(instruments, new_path):
+        midi.instruments = [instrument]
+        midi.write(directory + str(i) + '.mid')
+        if audio:
+            write_wav(midi.synthesize(), directory + str(i) + '.wav')
+    midi.instruments = instruments
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split the melody, chord and root tracks of the songs in MIDI/')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes. Default = 1')
+    parser.add_argument('--audio', dest='audio', action='store_true', help='Also render each track to .wav')
+    args = parser.parse_args()
+
+    # get the list of midfiles and csvfiles
+    path = 'MIDI/'
+    midfiles = []
+    csvfiles = []
+    for file in os.listdir(path):
+        if file.endswith('.mid'): midfiles.append(path+file)
+        if file.endswith('.csv'): csvfiles.append(path+file)
+    midfiles.sort()
+    csvfiles.sort()
+
+    # record the key and mode in csvfiles
+    bars = []
+    for csvfile in csvfiles:
+        with open(csvfile, 'rb') as file:
+            reader = csv.reader(file, delimiter=',')
+            rows = iter(reader)
+            next(rows)
+            for row in rows:
+                bars.append(int(row[-1]))
+
+    jobs = [(i, midfiles[i], args.audio) for i in range(len(midfiles)) if bars[i] <= 8]
+    if args.workers > 1:
+        pool = Pool(args.workers)
+        pool.map(separate, jobs, chunksize=16)
+        pool.close()
+        pool.join()
+    else:
+        map(separate, jobs)
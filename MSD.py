@@ -1,41 +1,70 @@
-
 import pretty_midi
-import math
-import csv
+import argparse
 import numpy as np
+from multiprocessing import Pool
 from util import *
 from os import listdir
 from os.path import isfile, join
-from scipy import stats
+
+
+def chord_tracks(path):
+    """
+    Find the instruments of a MIDI file that only play chords
+
+    :return: list of (instrument index, chords), chords is a list of (number of notes, root, type, start, end).
+             None if the file can't be parsed
+    """
+    try:
+        midi = pretty_midi.PrettyMIDI(path) # load MIDI file
+    except Exception as e:
+        print(e)
+        return None
+    tracks = []
+    for k, instrument in enumerate(midi.instruments):
+        chord_list = isChord(instrument.notes)
+        if chord_list:
+            # chromas of all the chords of the instrument, recognized at once
+            group = np.repeat(np.arange(len(chord_list)), [len(chord) for chord in chord_list])
+            pitch = np.array([note.pitch for chord in chord_list for note in chord])
+            chroma = np.zeros((len(chord_list), 12), dtype=int)
+            chroma[group, pitch % 12] = 1
+            roots, chord_types = chroma2chord_batch(chroma)
+            tracks.append((k, [(len(chord), r, t, chord[0].start, chord[0].end)
+                               for chord, r, t in zip(chord_list, roots, chord_types)]))
+    return tracks
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Find the instruments made only of chords in MIDI_MSD/')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes. Default = 1')
+    args = parser.parse_args()
+
     # get the list of pathname in the directory TheoryTab
     path = 'MIDI_MSD/'
-    onlyfiles = [ f for f in listdir(path) if isfile(join(path,f))]
+    onlyfiles = sorted(f for f in listdir(path) if isfile(join(path,f)))
     # initialize
     song = [] # List of song names
-    errorSong = []
-    errorCnt = [0] * len(onlyfiles)
-
-    numType = 5 # maj, min, maj7, 7, min7
-    numSong = len(onlyfiles)
-    melody = np.zeros((numSong, 12, 128), dtype = int)
-    chord  = np.zeros((numSong, 12, 128), dtype = int)
-    root   = np.zeros((numSong, 12, 128), dtype = int)
-
-    for i in range(len(onlyfiles)):
-        song.append(onlyfiles[i][0:-4].split(';'))
-        song[i].append(path + onlyfiles[i])
-        midi = pretty_midi.PrettyMIDI(song[i][-1]) # load MIDI file
-        for k in range(len(midi.instruments)):
-            notes = midi.instruments[k].notes # all notes in the i-th song
-            #unit = (notes[-1].end)/128
-            chord_list = isChord(notes)
-            if chord_list:
-                print("\n%dth song, %dth instrument are all chords" %(i, k))
-                for chord in chord_list:
-                    chroma = np.zeros((1,12,1))
-                    for j in range(len(chord)):
-                        chroma[0][chord[j].pitch%12][0] = 1
-                    r, t = chroma2chord_v2(chroma[0][:][:,0])
-                    print('%d notes in a %s%s,\t t=[%0.3f, %0.3f]' %(len(chord), int2note(r), int2type(t), chord[0].start, chord[0].end))
+    for f in onlyfiles:
+        song.append(f[0:-4].split(';'))
+        song[-1].append(path + f)
+
+    if args.workers > 1:
+        pool = Pool(args.workers)
+        results = pool.imap(chord_tracks, [s[-1] for s in song], chunksize=8)
+    else:
+        results = (chord_tracks(s[-1]) for s in song)
+
+    chordtracks = []
+    for i, tracks in enumerate(results):
+        for k, chords in tracks or []:
+            print("\n%dth song, %dth instrument are all chords" %(i, k))
+            for n, r, t, start, end in chords:
+                print('%d notes in a %s%s,\t t=[%0.3f, %0.3f]' %(n, notes.lookup(r), types.lookup(t), start, end))
+            chordtracks.append((song[i][-1], k))
+
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+    print("\n%d chord tracks in %d files:" % (len(chordtracks), len(song)))
+    for f, k in chordtracks:
+        print("%s\tinstrument %d" % (f, k))
@@ -3,6 +3,7 @@ from util import *
 from utils.load_data import *
 from utils.build_chord_repr import *
 from utils.history_writer import *
+from utils.prefetch import Prefetcher
 from tqdm import trange
 from sklearn.metrics import classification_report,confusion_matrix
 from collections import Counter
@@ -19,6 +20,32 @@ class TrainingStrategy(object):
     def test(self, model):
         raise NotImplementedError('override this!')
 
+    def batches(self, transform):
+        """
+        :param transform: function from a padded Data batch of the train set to what fit_generator takes,
+                          applied after the transposition augmentation of args.augment
+        :return: Prefetcher over the transformed batches, see prefetch.py. Each fit_generator call takes
+                 one_epoch(), with samples_per_epoch the number of samples of an epoch
+        """
+        args = self.args
+        mode = args.augment if 'augment' in args and args.augment else 'none'
+        # bucketed batches are cut to their longest song instead of seq_len
+        length = None if self.bucket else self.seq_len
+        if self.bucket:
+            lengths = self.train_data.lengths
+            print "Bucketing %d songs of %d to %d frames (%.0f%% of seq_len on average)" % (
+                len(lengths), lengths.min(), lengths.max(), 100. * lengths.mean() / self.seq_len)
+        return Prefetcher(lambda: self.train_data.batches(args.batch_size, length=length, bucket=self.bucket),
+                          lambda batch: transform(augment(batch, mode)),
+                          workers=args.prefetch_workers, size=args.prefetch)
+
+    def songs_per_epoch(self):
+        """
+        :return: number of (augmented) train songs of an epoch
+        """
+        mode = self.args.augment if 'augment' in self.args and self.args.augment else 'none'
+        return AUGMENTATIONS[mode] * self.nb_train
+
     @staticmethod
     def get_filename(_alg):
         major = _alg.strategy
@@ -35,6 +62,8 @@ class TrainingStrategy(object):
         fn += '_nodes' + str(_alg.nodes1)
         if 'mtl_ratio' in _alg and _alg.mtl_ratio != 0 and _alg.strategy == 'LM':
             fn += '_' + str(_alg.mtl_ratio)
+        if 'dataset' in _alg and _alg.dataset == 'big':
+            fn += '_big' + str(_alg.max_length)
         return fn
 
 
@@ -48,25 +77,33 @@ class LanguageModelTrainingStrategy(TrainingStrategy):
         self.chord2signatureChroma = top3notes
         self.ip = LanguageModelInputParser()
         nb_test = args.nb_test
-        data = load_data(args, nb_test)
-        train_data = data['train']
-        test_data = data['test']
+        self.seq_len = args.max_length if 'dataset' in args and args.dataset == 'big' else 128
+        self.bucket = 'bucket' in args and args.bucket
+        # the train set stays packed, batches are padded and transcoded on the fly
+        data = load_packed_data(args, nb_test)
+        self.train_data = data['train']
+        test_data = data['test'].padded(length=self.seq_len)
 
         DataSet = namedtuple('DataSet', ['x', 'y_chroma', 'y_onehot', 'sw'])
-        x, y12, y1 = self.ip.get_XY(train_data.melody, train_data.chord)
-        self.trainset = DataSet(x=x, y_chroma=y12, y_onehot=y1, sw=train_data.sw)
         x, y12, y1 = self.ip.get_XY(test_data.melody, test_data.chord)
+        if self.bucket:
+            mask_padding(x, test_data.sw)
         self.testset = DataSet(x=x, y_chroma=y12, y_onehot=y1, sw=test_data.sw)
 
         self.x_test = test_data.melody
-        self.seq_len = 128
-        self.ydim = self.trainset.y_onehot.shape[2]
-        self.nb_train = train_data.melody.shape[0]
+        self.ydim = self.ip.transcoder.size
+        self.nb_train = len(self.train_data)
         self.nb_test = test_data.melody.shape[0]
 
     def get_ydim(self):
         return self.ydim
 
+    def transform(self, batch):
+        x, y12, y1 = self.ip.get_XY(batch.melody, batch.chord)
+        if self.bucket:
+            mask_padding(x, batch.sw)
+        return x, {'one-hot': y1, 'chroma': y12}, {'one-hot': batch.sw, 'chroma': batch.sw}
+
     def train(self, model):
         if self.args.debug:
             nb_epoch = 1
@@ -75,10 +112,10 @@ class LanguageModelTrainingStrategy(TrainingStrategy):
         batch_size = self.args.batch_size
         seq_len = self.seq_len
         nb_test = self.nb_test
-        train = self.trainset
         test = self.testset
         x_test = self.x_test
         filename = self.get_filename(self.args)
+        batches = self.batches(self.transform)
 
         Pair = namedtuple('Pair', ['onehot', 'chroma'])
         Triple = namedtuple('Triple', ['onehot', 'chroma', 'ensemble'])
@@ -90,13 +127,11 @@ class LanguageModelTrainingStrategy(TrainingStrategy):
             history = HistoryWriterLM(csvfile)
             pbar = trange(nb_epoch)
             for i in pbar:
-                hist = model.fit(train.x, {'one-hot': train.y_onehot, 'chroma': train.y_chroma},
-                                 nb_epoch=1, verbose=0,
-                                 batch_size=batch_size,
-                                 sample_weight={'one-hot': train.sw, 'chroma': train.sw},
-                                 validation_data=(test.x,
-                                                  {'one-hot': test.y_onehot, 'chroma': test.y_chroma},
-                                                  {'one-hot': test.sw, 'chroma': test.sw}))
+                hist = model.fit_generator(batches.one_epoch(), samples_per_epoch=self.songs_per_epoch(),
+                                           nb_epoch=1, verbose=0,
+                                           validation_data=(test.x,
+                                                            {'one-hot': test.y_onehot, 'chroma': test.y_chroma},
+                                                            {'one-hot': test.sw, 'chroma': test.sw}))
                 # testing
                 pred = Pair(*model.predict(x_test))
                 pred_avg = Pair(onehot=smooth(np.array(pred.onehot)),
@@ -133,6 +168,7 @@ class LanguageModelTrainingStrategy(TrainingStrategy):
                 #test_y_oh_erranaly = np.argmax(test.y_onehot,axis=2).flatten() # (30 x 128,)
                 #print classification_report(test_y_oh_erranaly, pred_oh_erranaly)
                 #print confusion_matrix(test_y_oh_erranaly,pred_oh_erranaly)
+        batches.close()
 
 
 
@@ -143,19 +179,30 @@ class IterativeImproveStrategy(TrainingStrategy):
         self.ip = PairedInputParser(args)
         self.nb_test = args.nb_test
         self.c2o_transcoder = ChordNotes2OneHotTranscoder()
-        data = load_data(args, self.nb_test)
-        train_data = data['train']
-        test_data = data['test']
+        if 'dataset' in args and args.dataset == 'big':
+            # testing pairs every test song with every padded train song
+            raise ValueError('pair strategy only runs on the csv dataset')
+        self.seq_len = 128
+        self.bucket = 'bucket' in args and args.bucket
+        # training pairs are made batch by batch, the padded train set is only needed to test
+        data = load_packed_data(args, self.nb_test)
+        self.train_data = data['train']
+        train_data = self.train_data.padded(length=self.seq_len)
+        test_data = data['test'].padded(length=self.seq_len)
 
         DataSet = namedtuple('DataSet', ['x', 'y', 'sw'])
-        x, y = self.ip.get_XY(train_data.melody, train_data.chord)
-        self.trainset = DataSet(x, y, np.tile(train_data.sw, (2, 1)))
         x, y = self.ip.get_XY(test_data.melody, test_data.chord)
-        self.testset = DataSet(x, y, np.tile(test_data.sw, (2, 1)))
+        sw = np.tile(test_data.sw, (1 + self.ip.negatives, 1))
+        if self.bucket:
+            mask_padding(x, sw)
+        self.testset = DataSet(x, y, sw)
         self.x_test = get_test(args, m=test_data.melody, M=train_data.melody, C=train_data.chord)
+        self.test_sw = test_data.sw
+        if self.bucket:
+            # the candidate chords of a test song follow each other
+            mask_padding(self.x_test, np.repeat(self.test_sw, len(self.x_test) // len(self.test_sw), axis=0))
         self.test_chord, self.train_chord = test_data.chord, train_data.chord
         self.test_melody, self.test_melody = test_data.melody, train_data.melody
-        self.seq_len = 128
         self.nb_train = train_data.melody.shape[0]
         self.nb_test = test_data.melody.shape[0]
         self.test_freq = 1
@@ -166,6 +213,17 @@ class IterativeImproveStrategy(TrainingStrategy):
         # self.best1 = self.best_matches[:, 0].ravel()
         # self.knn_err_count_avg = np.average(np.abs(train_data.chord[self.best1] - test_data.chord)) * 12
 
+    def pairs(self, batch):
+        """
+        Pair the songs of a batch with negative chords drawn from the whole train set, anew for every batch
+        """
+        negatives = np.random.randint(self.nb_train, size=len(batch.chord) * self.ip.negatives)
+        C_neg = self.train_data.padded(negatives, length=batch.chord.shape[1]).chord
+        x, y = self.ip.get_XY(batch.melody, batch.chord, C_neg)
+        if self.bucket:
+            mask_padding(x, np.tile(batch.sw, (1 + self.ip.negatives, 1)))
+        return x, y
+
     def train(self, model):
         if self.args.debug:
             nb_epoch = 1
@@ -177,7 +235,6 @@ class IterativeImproveStrategy(TrainingStrategy):
             test_freq = self.test_freq
 
         args = self.args
-        train = self.trainset
         test = self.testset
         x_test = self.x_test
         test_chord, train_chord = self.test_chord, self.train_chord
@@ -195,18 +252,20 @@ class IterativeImproveStrategy(TrainingStrategy):
         plt.savefig("freq_histogram.png")
 
         filename = self.get_filename(self.args)
+        batches = self.batches(self.pairs)
         print "Result will be written to history/{0}.csv and {0}-results.txt".format(filename)
         with open('history/' + filename + '.csv', 'w') as csvfile:
             history = HistoryWriterPair(csvfile)
             pbar = trange(nb_epoch)
             pbar.set_postfix(train_loss='_', test_loss='_', errCntAvg='_')
             for i in pbar:
-                hist = model.fit(train.x, train.y,
-                                 nb_epoch=1, verbose=0,
-                                 batch_size=batch_size,
-                                 validation_data=(test.x, test.y))
+                # each song of the batch makes a positive pair and ip.negatives negative pairs
+                hist = model.fit_generator(batches.one_epoch(),
+                                           samples_per_epoch=(1 + self.ip.negatives) * self.songs_per_epoch(),
+                                           nb_epoch=1, verbose=0,
+                                           validation_data=(test.x, test.y))
                 if i % self.test_freq == 0:
-                    pred = np.array(model.predict(x_test)).reshape((nb_test, -1, 128, 24))
+                    pred = np.array(model.predict(x_test)).reshape((nb_test, -1, self.seq_len, 24))
                     errs = np.sum(pred, axis=(2,3))
                     idx = np.argmin(errs, axis=1)  # 100,
                     c_hat = train_chord[idx].astype(int)  # 100, 128, 12
@@ -226,7 +285,9 @@ class IterativeImproveStrategy(TrainingStrategy):
                             np.save('../pred/' + filename + 'Corrected' + str(j) +'.npy', corrected)
                             np.save('../pred/' + filename + 'CorrectedAvg' + str(j) + '.npy', smooth(corrected))
                             x_test_correct = np.concatenate((test_melody[idx], corrected), 2)
-                            pred = np.array(model.predict(x_test_correct)).reshape((nb_test, 128, 24))
+                            if self.bucket:
+                                mask_padding(x_test_correct, self.test_sw)
+                            pred = np.array(model.predict(x_test_correct)).reshape((nb_test, self.seq_len, 24))
                             # err_count_avg = np.average(np.abs(corrected - test_chord)) * 12
                     bestN, uniq_idx, norm = print_result(c_hat, test_chord, train_chord, args, 1)
                     err_count_avg = np.average(np.abs(c_hat - test_chord)) * 12
@@ -246,6 +307,7 @@ class IterativeImproveStrategy(TrainingStrategy):
                     #print test_chord_oh
                     #print classification_report(c_hat_oh.flatten(), test_chord_oh.flatten())
                     #print confusion_matrix(c_hat_oh.flatten(), test_chord_oh.flatten()).shape
+        batches.close()
 
 
 
@@ -1,36 +1,21 @@
-import numpy as np
-from util import *
+import argparse
+from utils.load_data import parse_data_compact, validation_report
 
 """
 There are 2% of chord progression that are empty!!!
 """
 
-M,m,C,c,R,r = load_data(100)
-cnt = 0
-cntErr = 0
-cntErrEmpty = 0
-badId = np.zeros((len(R), 1))
-for i in range(len(R)):
-    for j in range(len(R[i])):
-        for k in range(len(R[i][j])):
-            if R[i][j][k] and not C[i][j][k]:
-                badId[i] = 1
-                if np.sum(C[i][j]):
-                    #print R[i][j],
-                    #print C[i][j]
-                    pass
-                else:
-                    cntErrEmpty += 1
-                cntErr += 1
-            cnt += 1
-    if (badId[i]):
-        print("%d " %(i)),
-
-
-
-print(cnt)
-print(cntErr)
-print(cntErrEmpty)
-print(cntErr*100/cnt)
-print(cntErrEmpty*100/cnt)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report the frames and songs failing the dataset checks')
+    parser.add_argument('model', nargs='?', help='Default = GRU correct')
+    args = parser.parse_args()
+    args.model = args.model if args.model else 'GRU correct'
 
+    C, M, sw = parse_data_compact(args, 128)
+    report = validation_report(args, C, sw)
+    for check, result in sorted(report['checks'].items()):
+        print("%s: %d frames (%.2f%%) in %d songs" % (check, result['frames'],
+                                                      result['frames'] * 100.0 / report['frames'],
+                                                      len(result['songs'])))
+        print(" ".join(str(i) for i in result['songs']))
+    print(report['frames'])
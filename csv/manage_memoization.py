@@ -1,43 +1,37 @@
-from os import path, devnull, remove
+from os import path, remove
+import sys
 import argparse
-import csv
 
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'utils'))
+import npy_cache
 
-def empty_file(path):
-    open(path, 'w').close()
+# paths relative to csv/, where this script is run
+SOURCES = [path.basename(source) for source in npy_cache.SOURCES]
+CACHE_DIR = 'cache'
 
 
-def delete_files(univ, config):
-    def delete(args):
-        for prefix in univ:
-            removeable = [prefix + '-' + suffix + '.npy' for suffix in [
-                'chord', 'melody', 'sampleweight'
-            ]]
-            for rm in removeable:
-                print "removing %s" % rm
-                try:
-                    remove(rm)
-                except Exception:
-                    print "Error removing %s" % rm
+def delete_files(args):
+    stale = set(npy_cache.stale(SOURCES, CACHE_DIR))
+    for variant, key, name in npy_cache.entries(CACHE_DIR):
+        if args.stale and name not in stale:
+            continue
+        print "removing %s" % name
+        try:
+            remove(path.join(CACHE_DIR, name))
+        except Exception:
+            print "Error removing %s" % name
 
-        # reset the bookkeeping file
-        empty_file(config)
-    return delete
 
 if __name__ == '__main__':
-    config = 'npy-exists.config'
-    if path.exists(config):
-        available = [row[0] for row in csv.reader(open(config))]
-        print "Found files : %r" % available
-    else:
-        available = []
+    stale = set(npy_cache.stale(SOURCES, CACHE_DIR))
+    print "Found files : %r" % [name + (' (stale)' if name in stale else '')
+                                for _, _, name in npy_cache.entries(CACHE_DIR)]
 
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
     clean = subparsers.add_parser('clean')
-    clean.set_defaults(func=delete_files(available, config))
+    clean.add_argument('--stale', action='store_true', help='Only remove the files of outdated CSVs')
+    clean.set_defaults(func=delete_files)
     args = parser.parse_args()
 
     args.func(args)
-
-
@@ -1,138 +1,155 @@
-
 import pretty_midi
 import math
 import csv
+import argparse
 import numpy as np
 import os
+from multiprocessing import Pool
 from scipy import stats
 from util import *
 
-# get the list of midfiles and csvfiles
-path = 'MIDI/'
-midfiles = []
-csvfiles = []
-for file in os.listdir(path):
-    if file.endswith('.mid'): midfiles.append(path+file)
-    if file.endswith('.csv'): csvfiles.append(path+file)
-midfiles.sort()
-csvfiles.sort()
-
-# record the key and mode in csvfiles
-keys = []
-modes = []
-bars = []
-skip = []
-for csvfile in csvfiles:
-    with open(csvfile, 'rb') as file:
-        reader = csv.reader(file, delimiter=',')
-        rows = iter(reader)
-        next(rows)
-        for row in rows:
-            key, mode = toMajKey(notes.lookup_idx(row[5]), modes.lookup_idx(row[6]))
-            keys.append(key)
-            modes.append(mode)
-            bars.append(int(row[-1]))
-assert len(keys) == len(modes) == len(midfiles)
-
-# initialize
-numSong = len(midfiles)
-numType = 5 # maj, min, maj7, 7, min7
-errorSong = []
-errorCnt = [0] * numSong
-melody = np.zeros((numSong, 12, 128), dtype = int)
-chord  = np.zeros((numSong, 12, 128), dtype = int)
-root   = np.zeros((numSong, 12, 128), dtype = int)
-R = np.zeros((numSong, 128), dtype = int)
-M = np.zeros((numSong, 128), dtype = int)
-
-for i in range(len(midfiles)):
-    if bars[i] > 8: continue
-    midi = pretty_midi.PrettyMIDI(midfiles[i]) # load MIDI file
-    unit = midi.instruments[1].notes[-1].end/128 # the smallest time unit
-    for k in range(len(midi.instruments)):
-        notes = midi.instruments[k].notes # all notes in the i-th song
-        for j in xrange(len(notes)):
-            notes[j].start /= float(unit)
-            notes[j].end   /= float(unit)
 
+def parse_song(job):
+    """
+    Read the melody, chord and root tracks of a TheoryTab MIDI file, transposed to C
+
+    :param job: (path of the MIDI file, major key of the song)
+    :return: (melody, chord, root, errorCnt). The tracks are (12, 128),
+             errorCnt counts the notes that don't start or end close to a time unit
+    """
+    midfile, key = job
+    melody = np.zeros((12, 128), dtype = int)
+    chord  = np.zeros((12, 128), dtype = int)
+    root   = np.zeros((12, 128), dtype = int)
+    errorCnt = 0
+    midi = pretty_midi.PrettyMIDI(midfile) # load MIDI file
+    unit = float(midi.instruments[1].notes[-1].end/128) # the smallest time unit
+    tracks = (melody, chord, root)
+    # the notes of every instrument count as errors, only the first 3 are kept. Files with fewer tracks don't fail
+    for k, instrument in enumerate(midi.instruments):
+        for n in instrument.notes: # all notes of the k-th track
             # filter out mis-matched songs
-            t1 = round((notes[j].start),2)
-            t2 = round((notes[j].end),2)
+            t1 = round(n.start/unit, 2)
+            t2 = round(n.end/unit, 2)
             diff1 = t1-math.floor(t1)
             diff2 = t2-math.floor(t2)
             thres = 0.3
             if (diff1 < 1-thres and diff1 > thres) or (diff2 < 1-thres and diff2 > thres) :
-                errorCnt[i] += 1
+                errorCnt += 1
 
             # save data of melody, chord, and root
-            note = (notes[j].pitch - keys[i]) % 12
-            idx1 = int(round(t1))
-            idx2 = int(round(t2))
-            if k==0: melody[i][note][idx1:idx2] = np.ones((idx2-idx1))
-            if k==1:  chord[i][note][idx1:idx2] = np.ones((idx2-idx1))
-            if k==2:   root[i][note][idx1:idx2] = np.ones((idx2-idx1))
-
-for i in list(reversed(range(len(errorCnt)))):
+            if k < len(tracks):
+                note = (n.pitch - key) % 12
+                tracks[k][note][int(round(t1)):int(round(t2))] = 1
+    return melody, chord, root, errorCnt
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the csv/ dataset from the TheoryTab songs in MIDI/')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes. Default = 1')
+    args = parser.parse_args()
+
+    # get the list of midfiles and csvfiles
+    path = 'MIDI/'
+    midfiles = []
+    csvfiles = []
+    for file in os.listdir(path):
+        if file.endswith('.mid'): midfiles.append(path+file)
+        if file.endswith('.csv'): csvfiles.append(path+file)
+    midfiles.sort()
+    csvfiles.sort()
+
+    # record the key and mode in csvfiles
+    keys = []
+    keymodes = []
+    bars = []
+    for csvfile in csvfiles:
+        with open(csvfile, 'rb') as file:
+            reader = csv.reader(file, delimiter=',')
+            rows = iter(reader)
+            next(rows)
+            for row in rows:
+                key, mode = toMajKey(notes.lookup_idx(row[5]), modes.lookup_idx(row[6]))
+                keys.append(key)
+                keymodes.append(mode)
+                bars.append(int(row[-1]))
+    assert len(keys) == len(keymodes) == len(midfiles)
+
+    # initialize
+    numSong = len(midfiles)
+    numType = 5 # maj, min, maj7, 7, min7
+    errorCnt = np.zeros(numSong, dtype = int)
+    melody = np.zeros((numSong, 12, 128), dtype = int)
+    chord  = np.zeros((numSong, 12, 128), dtype = int)
+    root   = np.zeros((numSong, 12, 128), dtype = int)
+
+    # songs longer than 8 bars are left empty
+    songs = [i for i in range(numSong) if bars[i] <= 8]
+    jobs = [(midfiles[i], keys[i]) for i in songs]
+    if args.workers > 1:
+        pool = Pool(args.workers)
+        results = pool.imap(parse_song, jobs, chunksize=8)
+    else:
+        results = (parse_song(job) for job in jobs)
+    for i, (m, c, r, e) in zip(songs, results):
+        melody[i], chord[i], root[i], errorCnt[i] = m, c, r, e
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+
     # most of the errors come from the root
     # a few errors come from the melody
     # no errors come from the chord
-    if errorCnt[i] > 40:
+    keep = errorCnt <= 40
+    for i in np.nonzero(~keep)[0]:
         print midfiles[i], 'err=', errorCnt[i], 'bars=', bars[i]
-        melody = np.delete(melody, (i), axis=0)
-        chord  = np.delete(chord,  (i), axis=0)
-        root   = np.delete(root,   (i), axis=0)
-        del errorCnt[i]
-
-numSong = len(melody)
-template        = np.zeros((12*numType,12), dtype=int)
-templateMerged  = np.zeros((numType,12), dtype=int)
-templateNorm    = np.zeros((numType,12), dtype=float)
-
-for i in range(numSong):
-    for j in range(128):
-        r = np.nonzero(  root[i][:][:,j])[0]
-        m = np.nonzero(melody[i][:][:,j])[0]
-        if len(r)==1: # many len(r) equals 0, meaning that many instances are not counted
-            chord[i][r[0]][j] = 1
-        r,t = chroma2chord_v2(chord[i][:][:,j])
-        if t not in [1,2,3,4,5]: t=0
-        R[i][j] = r
-        if len(m)==1 and t:
-            M[i][j] = m[0]
-            template[(t-1)*12+r][m[0]] += 1
-
-for i in range(12):
-    for j in range(12):
-        for k in range(numType):
-            templateMerged[k][i] += template[j+12*k][(i+j)%12]
-
-# normalize the template
-templateNorm = stats.zscore(templateMerged, axis=1)
-templateNorm[np.isnan(templateNorm)] = 0
-
-melody = melody.reshape((numSong,12*128))
-chord  = chord .reshape((numSong,12*128))
-root   = root  .reshape((numSong,12*128))
-
-melody.tolist()
-chord.tolist()
-root.tolist()
-R.tolist()
-templateMerged.tolist()
-templateNorm.tolist()
-
-with open('csv/melody.csv', 'wb') as f:
-    writer = csv.writer(f)
-    writer.writerows(M)
-with open('csv/chord.csv', 'wb') as f:
-    writer = csv.writer(f)
-    writer.writerows(chord)
-with open('csv/root.csv', 'wb') as f:
-    writer = csv.writer(f)
-    writer.writerows(R)
-with open('csv/template.csv', 'wb') as f:
-    writer = csv.writer(f)
-    writer.writerows(templateMerged)
-with open('csv/templateN.csv', 'wb') as f:
-    writer = csv.writer(f)
-    writer.writerows(templateNorm)
+    melody, chord, root = melody[keep], chord[keep], root[keep]
+
+    numSong = len(melody)
+    M = np.zeros((numSong, 128), dtype = int)
+    template        = np.zeros((12*numType,12), dtype=int)
+
+    # add the root to the chord of the frames with a single root note
+    # many frames have no root, meaning that many instances are not counted
+    song, frame = np.nonzero((root != 0).sum(axis=1) == 1)
+    chord[song, root.argmax(axis=1)[song, frame], frame] = 1
+
+    # recognize the chords of all frames at once
+    R, T = chroma2chord_batch(chord.transpose(0, 2, 1).reshape(-1, 12))
+    R, T = R.reshape(numSong, 128), T.reshape(numSong, 128)
+    T[(T < 1) | (T > numType)] = 0
+
+    # count the melody note of the frames with a single melody note and a known chord
+    counted = ((melody != 0).sum(axis=1) == 1) & (T > 0)
+    m = melody.argmax(axis=1)[counted]
+    M[counted] = m
+    np.add.at(template, ((T[counted]-1)*12 + R[counted], m), 1)
+
+    # fold the 12 roots of each chord type onto C: templateMerged[k][i] = sum_j template[j+12*k][(i+j)%12]
+    rotation = (np.arange(12)[:, None] + np.arange(12)[None, :]) % 12
+    templateMerged = template.reshape(numType, 12, 12)[:, np.arange(12)[:, None], rotation].sum(axis=1)
+
+    # normalize the template
+    templateNorm = stats.zscore(templateMerged, axis=1)
+    templateNorm[np.isnan(templateNorm)] = 0
+
+    melody = melody.reshape((numSong,12*128))
+    chord  = chord .reshape((numSong,12*128))
+    root   = root  .reshape((numSong,12*128))
+
+    # every matrix is written once, after filtering
+    with open('csv/melody.csv', 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerows(M)
+    with open('csv/chord.csv', 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerows(chord)
+    with open('csv/root.csv', 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerows(R)
+    with open('csv/template.csv', 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerows(templateMerged)
+    with open('csv/templateN.csv', 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerows(templateNorm)
@@ -1,10 +1,13 @@
 from os import listdir
 from os.path import isfile, join
+from utils import npy_cache
+from utils.packed import unpack_chroma, unpack_melody
 mypath = '../pred/'
 files = [f for f in listdir(mypath) if isfile(join(mypath, f))]
 midi_output_path = 'midi_out/'
-M = np.load('csv/normal-melody.npy')
-C = np.load('csv/normal-chord.npy')
+# bit-packed arrays cached by load_data.parse_data_compact
+cached = npy_cache.load(npy_cache.prefix('normal'), ('melody', 'chord'))
+M, C = unpack_melody(cached['melody']), unpack_chroma(cached['chord'])
 
 for i in range(10):
     song_ground = util.matrices2midi(M[i], C[i])
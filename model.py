@@ -4,11 +4,12 @@ import csv
 from AttLayer import AttLayer
 from keras.layers import Input, Dense, Dropout, Reshape, Permute, merge, Flatten
 from keras.layers import Convolution2D, Convolution3D, ZeroPadding2D, ZeroPadding3D
-from keras.layers import LSTM, GRU, SimpleRNN, TimeDistributed, Lambda
+from keras.layers import LSTM, GRU, SimpleRNN, TimeDistributed, Lambda, Masking
 from keras.models import Model, model_from_json
 from keras.optimizers import RMSprop
 from keras.callbacks import EarlyStopping
 from keras import backend as K
+from utils.load_data import MASK_VALUE
 
 modelpath = 'model2/'
 
@@ -30,6 +31,9 @@ def gen_input(feat, seq_len):
 
 def build(alg, input, nodes, drp):
     return_sequences = True
+    if 'bucket' in alg and alg.bucket:
+        # padding frames of the variable length batches are skipped by the recurrent layers and the loss
+        input = Masking(mask_value=MASK_VALUE)(input)
     if 'RNN' in alg.model:
         M1 = SimpleRNN(nodes, return_sequences=return_sequences)(input)
         M2 = SimpleRNN(nodes, return_sequences=return_sequences, go_backwards=True)(input)
@@ -0,0 +1,163 @@
+"""
+Bookkeeping that lets preprocess/main.py resume a crashed run, and rerun on a grown corpus, without redoing work
+
+- Manifest: one JSON line per processed MIDI file, keyed by its path and content hash. It records whether the file
+  was accepted, its label and where its tracks were written
+- NoteCache: the notes and metadata of every parsed MIDI file, keyed by content hash, so that relabeling a file
+  (e.g. with other parameters) doesn't parse it again
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import pretty_midi
+import track
+import util
+
+
+def filehash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def uptodate(entry, digest, params):
+    """
+    Whether a manifest entry is still valid for a file of content hash digest labeled with params
+    """
+    return (entry is not None and entry['hash'] == digest and entry['params'] == params and
+            all(os.path.exists(output) for output in entry['outputs']))
+
+
+def readmanifest(path):
+    """
+    :return: (entries by path, whether the file ends with a complete line)
+    """
+    entries = {}
+    newline = True
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                newline = line.endswith('\n')
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line of a crashed run
+                    continue
+                entries[entry['path']] = entry
+    return entries, newline
+
+
+class Manifest(object):
+    """
+    Append-only JSON lines file. Later lines override earlier ones of the same path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries, newline = readmanifest(path)
+        util.makedirs(path)
+        self.file = open(path, 'a')
+        if not newline:
+            self.file.write('\n')
+
+    def get(self, path):
+        return self.entries.get(path)
+
+    def add(self, entry):
+        self.entries[entry['path']] = entry
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class NoteCache(object):
+    """
+    One .npz per parsed file, holding the instruments (notes, pitch bends, control changes) and the metadata
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + '.npz')
+
+    def readmidi(self, path, digest):
+        """
+        Same as track.readmidi, but parses the file only if it isn't in the cache yet
+        """
+        cached = self.path(digest)
+        if os.path.exists(cached):
+            return load(cached)
+        metadata, instruments = track.readmidi(path)
+        util.makedirs(cached)
+        # workers may parse the same file concurrently, so write aside and rename
+        tmp = cached + '.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.savez(f, **pack(metadata, instruments))
+        os.rename(tmp, cached)
+        return metadata, instruments
+
+
+def pack(metadata, instruments):
+    notes = [note for instrument in instruments for note in instrument.notes]
+    bends = [bend for instrument in instruments for bend in instrument.pitch_bends]
+    ccs = [cc for instrument in instruments for cc in instrument.control_changes]
+    return {'program': np.array([instrument.program for instrument in instruments], dtype=int),
+            'is_drum': np.array([instrument.is_drum for instrument in instruments], dtype=bool),
+            'note_count': np.array([len(instrument.notes) for instrument in instruments], dtype=int),
+            'note_start': np.array([note.start for note in notes], dtype=float),
+            'note_end': np.array([note.end for note in notes], dtype=float),
+            'note_pitch': np.array([note.pitch for note in notes], dtype=int),
+            'note_velocity': np.array([note.velocity for note in notes], dtype=int),
+            'bend_count': np.array([len(instrument.pitch_bends) for instrument in instruments], dtype=int),
+            'bend_time': np.array([bend.time for bend in bends], dtype=float),
+            'bend_pitch': np.array([bend.pitch for bend in bends], dtype=int),
+            'cc_count': np.array([len(instrument.control_changes) for instrument in instruments], dtype=int),
+            'cc_time': np.array([cc.time for cc in ccs], dtype=float),
+            'cc_number': np.array([cc.number for cc in ccs], dtype=int),
+            'cc_value': np.array([cc.value for cc in ccs], dtype=int),
+            'tempos': np.array(metadata['tempos'], dtype=float),
+            'time_signatures': np.array([[ts.numerator, ts.denominator, ts.time]
+                                         for ts in metadata['time_signature_changes']], dtype=float).reshape(-1, 3),
+            'key_numbers': np.array(metadata['key_numbers'], dtype=int),
+            'end_time': np.array(metadata['end_time'], dtype=float),
+            'lyrics': np.array(metadata['lyrics'], dtype=object)}
+
+
+def load(path):
+    """
+    :return: (metadata, instruments), like track.readmidi
+    """
+    cached = np.load(path, allow_pickle=True)
+    notes = zip(cached['note_start'], cached['note_end'], cached['note_pitch'], cached['note_velocity'])
+    bends = zip(cached['bend_time'], cached['bend_pitch'])
+    ccs = zip(cached['cc_time'], cached['cc_number'], cached['cc_value'])
+    note_offsets = np.cumsum(np.append(0, cached['note_count']))
+    bend_offsets = np.cumsum(np.append(0, cached['bend_count']))
+    cc_offsets = np.cumsum(np.append(0, cached['cc_count']))
+
+    instruments = []
+    for i, (program, is_drum) in enumerate(zip(cached['program'], cached['is_drum'])):
+        instrument = pretty_midi.Instrument(program=int(program), is_drum=bool(is_drum))
+        instrument.notes = [pretty_midi.Note(int(velocity), int(pitch), float(start), float(end))
+                            for start, end, pitch, velocity in notes[note_offsets[i]:note_offsets[i+1]]]
+        instrument.pitch_bends = [pretty_midi.PitchBend(int(pitch), float(time))
+                                  for time, pitch in bends[bend_offsets[i]:bend_offsets[i+1]]]
+        instrument.control_changes = [pretty_midi.ControlChange(int(number), int(value), float(time))
+                                      for time, number, value in ccs[cc_offsets[i]:cc_offsets[i+1]]]
+        instruments.append(instrument)
+
+    metadata = {'n_instruments': len(instruments),
+                'program_numbers': [i.program for i in instruments if not i.is_drum],
+                'key_numbers': list(cached['key_numbers']),
+                'tempos': list(cached['tempos']),
+                'time_signature_changes': [pretty_midi.TimeSignature(int(numerator), int(denominator), float(time))
+                                           for numerator, denominator, time in cached['time_signatures']],
+                'end_time': float(cached['end_time']),
+                'lyrics': list(cached['lyrics'])}
+    return metadata, instruments
@@ -1,34 +1,127 @@
 import os
+import time
+import argparse
+import itertools
+from collections import deque
+from multiprocessing import Pool
 import track
+import cache
+from stats import Stats, writereport
 
-pathlist = []
-pathcount = 0
-availablepathindex = []
-availablepathcount = 0
-Directory = '/Users/ericyang/224n/project/data'
-Directory = '.'
-for root, dirs, files in os.walk(Directory):
-    for file in files:
-        if file.endswith(".mid"):
-            print pathcount,
-            if pathcount <= 76831:
-                pathcount += 1
-                print ""
-                continue
-            path = (os.path.join(root, file))
-            localpath = path[len(Directory):]
-
-            pathlist.append(localpath)
-            pathcount += 1
-
-            available, label = track.labelmidi(path)
-            if available:
-                print "V",  localpath,
-                availablepathindex.append(pathcount-1)
-                availablepathcount += 1
-
-                track.labeltocsv(Directory, localpath, label)
-            print ""
-        #if pathcount == 3:
-        #    break
-print availablepathcount, "/", pathcount
+writers = {'npz': track.labeltonpz, 'csv': track.labeltocsv}
+
+
+def listmidi(directory):
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            if file.endswith(".mid"):
+                yield os.path.join(root, file)
+
+
+def label(job):
+    """
+    Label one MIDI file and write its tracks to midilabel/, unless its manifest entry is still up to date.
+    This runs inside the worker processes, so it only takes and returns picklable values
+
+    :param job: (directory, path, format, manifest entry of the file or None, note cache directory or None)
+    :return: (manifest entry, whether the entry is new, stats.Stats of the file)
+    """
+    directory, path, fmt, entry, cachedir = job
+    localpath = path[len(directory):]
+    runstats = Stats()
+    runstats.count('files')
+    with runstats.time('hash'):
+        digest = cache.filehash(path)
+    params = {'format': fmt}
+    if cache.uptodate(entry, digest, params):
+        runstats.count('uptodate')
+        runstats.count('accepted', int(entry['available']))
+        return entry, False, runstats
+
+    notecache = cache.NoteCache(cachedir) if cachedir else None
+    available, label, song = track.labelmidi(path, notecache, digest, runstats)
+    outputs = []
+    if available:
+        runstats.count('accepted')
+        with runstats.time('write'):
+            outputs = writers[fmt](song, localpath, label)
+    return {'path': localpath, 'hash': digest, 'params': params,
+            'available': available, 'label': list(label), 'outputs': outputs}, True, runstats
+
+
+def imap_bounded(pool, func, iterable, max_pending):
+    """
+    Ordered version of pool.imap that never keeps more than max_pending jobs in flight.
+    Pool.imap consumes the whole iterable up front, which we can't afford on a 178k files corpus
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Label melody, chord and bass tracks of every MIDI file in a directory')
+    parser.add_argument('directory', nargs='?', default='.', help='Default = .')
+    parser.add_argument('--workers', type=int, default=1, help='Number of labeling processes. Default = 1 (serial)')
+    parser.add_argument('--max_pending', type=int, help='Max number of files in flight. Default = 4 * workers')
+    parser.add_argument('--format', choices=sorted(writers), default='npz',
+                        help='Format of the midilabel/ tracks. Default = npz')
+    parser.add_argument('--manifest', default='midilabel/manifest.jsonl',
+                        help='Record of the processed files, files that did not change since are skipped. '
+                             'Default = midilabel/manifest.jsonl')
+    parser.add_argument('--cache', default='notecache', help='Directory of the parsed notes cache. Default = notecache')
+    parser.add_argument('--no_cache', dest='no_cache', action='store_true', help='Do not cache parsed notes')
+    parser.add_argument('--report', default='midilabel/report.json',
+                        help='JSON report of the stage timings and rejection counts, '
+                             'each run is added to it. Default = midilabel/report.json')
+    parser.add_argument('--report_interval', type=float, default=60,
+                        help='Seconds between progress summaries. Default = 60')
+    args = parser.parse_args()
+    Directory = args.directory
+    max_pending = args.max_pending if args.max_pending else 4 * args.workers
+    cachedir = None if args.no_cache else args.cache
+    manifest = cache.Manifest(args.manifest)
+
+    pathlist = []
+    pathcount = 0
+    availablepathindex = []
+    availablepathcount = 0
+    totals = Stats()
+    start = lastreport = time.time()
+
+    jobs = ((Directory, path, args.format, manifest.get(path[len(Directory):]), cachedir)
+            for path in listmidi(Directory))
+    if args.workers > 1:
+        pool = Pool(args.workers)
+        results = imap_bounded(pool, label, jobs, max_pending)
+    else:
+        results = itertools.imap(label, jobs)
+
+    for entry, new, runstats in results:
+        if new:
+            manifest.add(entry)
+        totals.merge(runstats)
+        localpath, available = entry['path'], entry['available']
+        print pathcount,
+        pathlist.append(localpath)
+        pathcount += 1
+        if available:
+            print "V",  localpath,
+            availablepathindex.append(pathcount-1)
+            availablepathcount += 1
+        print ""
+        if time.time() - lastreport > args.report_interval:
+            lastreport = time.time()
+            print totals.summary(lastreport - start)
+
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+    manifest.close()
+    print totals.summary(time.time() - start)
+    writereport(totals, time.time() - start, args.report)
+    print availablepathcount, "/", pathcount
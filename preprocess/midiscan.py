@@ -0,0 +1,131 @@
+"""
+Cheap pre-filter for labelmidi, which reads the raw bytes of a MIDI file instead of parsing it with pretty_midi
+
+It only decodes the meta events of the first track (tempo and time signature changes) and the note on/off and
+program change events needed to bound the number of instruments, so that most of the files labelmidi would reject
+are rejected before any note-level parse. It follows the reading logic of mido and the counting logic of
+pretty_midi, and errs on the side of letting a file through: whenever the scan can't tell, the full parse decides.
+"""
+import struct
+
+# number of data bytes of the channel messages, by high nibble of the status byte
+_channel_length = {0x80: 2, 0x90: 2, 0xa0: 2, 0xb0: 2, 0xc0: 1, 0xd0: 1, 0xe0: 2}
+# number of data bytes of the system common and real time messages
+_system_length = {0xf1: 1, 0xf2: 2, 0xf3: 1, 0xf6: 0, 0xf8: 0, 0xfa: 0, 0xfb: 0, 0xfc: 0, 0xfe: 0}
+
+
+def _varint(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7f)
+        if byte < 0x80:
+            return value, pos
+
+
+def _scan(data):
+    name, size = struct.unpack('>4sL', bytes(data[:8]))
+    if name != b'MThd':
+        raise ValueError('not a MIDI file')
+    _, n_tracks, resolution = struct.unpack('>hhh', bytes(data[8:14]))
+    pos = 8 + size
+
+    # pretty_midi starts at 120 bpm, a change at tick 0 replaces it, and repeated tempos are ignored
+    tick_scales = [60.0/(120.0*resolution)]
+    n_time_signatures = 0
+    # pretty_midi makes one instrument per (program, channel, track) that closes a note
+    instruments = set()
+    for track in xrange(n_tracks):
+        if track > 0 and len(instruments) >= 2:
+            break
+        name, size = struct.unpack('>4sL', bytes(data[pos:pos+8]))
+        if name != b'MTrk':
+            raise ValueError('no MTrk header at start of track')
+        pos += 8
+        end = pos + size
+        tick = 0
+        last_status = None
+        program = [0] * 16
+        opened = set()
+        while pos < end:
+            delta, pos = _varint(data, pos)
+            tick += delta
+            status = data[pos]
+            pos += 1
+            running = status < 0x80
+            if running:
+                if last_status is None:
+                    raise ValueError('running status without last status')
+                status = last_status
+            elif status != 0xff:
+                last_status = status
+
+            if status == 0xff:
+                meta_type = data[pos]
+                length, pos = _varint(data, pos + 1)
+                if track == 0 and meta_type == 0x51:
+                    tempo = (data[pos] << 16) | (data[pos+1] << 8) | data[pos+2]
+                    tick_scale = 60.0/((6e7/tempo)*resolution)
+                    if tick == 0:
+                        tick_scales = [tick_scale]
+                    elif tick_scale != tick_scales[-1]:
+                        tick_scales.append(tick_scale)
+                elif track == 0 and meta_type == 0x58:
+                    n_time_signatures += 1
+                pos += length
+            elif status in (0xf0, 0xf7):
+                # like mido, a running status data byte before a sysex is dropped
+                length, pos = _varint(data, pos)
+                pos += length
+            elif status >= 0xf0:
+                pos += _system_length[status] - running
+            else:
+                if running:
+                    pos -= 1
+                kind, channel = status & 0xf0, status & 0x0f
+                if kind == 0xc0:
+                    program[channel] = data[pos]
+                elif kind == 0x90 and data[pos+1] > 0:
+                    opened.add((channel, data[pos]))
+                elif kind in (0x80, 0x90) and (channel, data[pos]) in opened:
+                    instruments.add((program[channel], channel, track))
+                pos += _channel_length[kind]
+        if pos != end:
+            raise ValueError('track %d overruns its chunk' % track)
+
+    return {'n_tracks': n_tracks,
+            'n_time_signatures': n_time_signatures,
+            'n_tempos': len(tick_scales),
+            'max_instruments': len(instruments)}
+
+
+def scan(path):
+    """
+    :return: dict of n_tracks, n_time_signatures, n_tempos (as counted by pretty_midi) and max_instruments (an upper
+             bound of the number of pretty_midi instruments, counted up to 2), or None if the file can't be scanned
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = bytearray(f.read())
+        return _scan(data)
+    except Exception:
+        return None
+
+
+def reject(metadata):
+    """
+    The metadata filters of labelmidi, in the same order
+
+    :param metadata: the result of scan
+    :return: the reason to reject the file, or None if it has to be parsed
+    """
+    if metadata is None:
+        return None
+    if metadata['n_time_signatures'] != 1:
+        return 'time_signature'
+    if metadata['n_tempos'] != 1:
+        return 'tempo'
+    if metadata['max_instruments'] < 2:
+        return 'instrument_count'
+    return None
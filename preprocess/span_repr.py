@@ -5,143 +5,129 @@ This relies on other preprocessing code to parse MIDI into Numpy array that repr
 each 16th note. The new representation ('span representation') merges adjacent note and add a new
 entry to the vector which represent the number of notes merged this way.
 
-The program goes through each Numpy array file once.
+The input is a directory of packed shards built by utils/shards.py. Each shard is converted once, several at a time
+with --workers: its songs are expanded to (count, max_length, 12) chunk by chunk and written next to it, e.g. shard 4
+gives melody_span-00004.npy, chord_span-00004.npy and sw_span-00004.npy
+
+Usage: python preprocess/span_repr.py ../dataset/shards-1024-C --workers 4
 """
-import re
+import os
+import sys
+import json
 import argparse
-from collections import defaultdict
+from multiprocessing import Pool
 import numpy as np
-from tqdm import tqdm
-
-def allthesame(Iter):
-    i = Iter.next()
-    return all(x == i for x in Iter)
-
-
-def strip_dirs(fs):
-    """
-    strip the dir part from a list of files
-    """
-    if '/' in fs[0]:
-        dir = fs[0].rsplit('/', 1)[0]
-        return [f.rsplit('/', 1)[-1] for f in fs], dir
-    else:
-        return fs
-
-
-def categorize(fs):
-    fs = sorted(fs)
-    categories = defaultdict(list)
-    findnumber = re.compile('\d+')
-    for f in fs:
-        cat = f.split('_')[0]
-        mat = findnumber.search(f)
-        if mat is not None:
-            Id = (mat.group(0))
-        else:
-            Id = 0
-        categories[cat].append((Id, f))
-
-    results = []
-    Len = len(categories.values()[0])
-    for i in range(Len):
-        Id = int(categories.values()[0][0][0])
-        if not allthesame(List[i][0] for List in categories.values()):
-            raise ValueError('Some file of index %d are missing!' % Id)
-        res = {cat: val[i][1] for cat, val in categories.items()}
-        res['index'] = Id
-        results.append(res)
-    return results
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.shards import load_shard
 
 
 def span_formation(notes, mask, return_mask=False):
     """
-    span_formation goes through notes once, merging adjacent notes and indicate merging in the corresponding
-    length column. It also keep a running sum, and computes a new mask
+    span_formation merges adjacent equal notes of all songs at once, and indicates the number of merged notes
+    in a new length column. A song is its frames of non-zero mask, which must come first. When a song is shorter
+    than the array, one more span of zeros covers the padding, with mask 0
 
-    :param notes:
-    :param mask: the old mask
+    :param notes: (num_songs, Len, 12)
+    :param mask: the old mask (num_songs, Len)
     :param return_mask: whether to return mask
-    :return: (new notes, new mask)
+    :return: new notes (num_songs, Len, 13), and the new mask (num_songs, Len) if return_mask
     """
-    mask = mask.astype(bool)
-
     num_songs, Len = notes.shape[0], notes.shape[1]
-    new_notes = np.zeros([num_songs, Len, 13])
-    new_mask = np.zeros([num_songs, Len])
-    changes = (notes[:, :-1] - notes[:, 1:]).sum(axis=2)
-    print "song[10]= %r\n" % notes[10]
-    empty_note = np.zeros([1, 13])
-    with tqdm(total=num_songs) as pbar:
-        for i, diffs in enumerate(changes):
-            song = notes[i, mask[i]]
-
-            ends = diffs.nonzero()[0]
-            if len(ends) == 0:
-                new_song = np.zeros([L, 13])
-                new_song[0, -1] = Len
-                new_mask = np.zeros(Len)
-
-            if ends[-1] == len(song) - 1:
-                # avoid error when song is shortened than Len by mask
-                ends = ends[:-1]
-            # each index in ends is a end position for a note,
-            # because the note is different from the next
-            starts = np.append(0, ends + 1)
-            ends = np.append(ends, Len-1)
-            # therefore the next positions are the start pos, plus, of course, 0
-            lens = ends - starts + 1
-            try:
-                new_song = np.concatenate([song[starts], np.matrix(lens).T], axis=1)
-            except IndexError as ex:
-                print "i=", i
-                raise ex
-            totalLen = lens.sum()
-            if totalLen < Len:
-                # We would like the total length to be
-                new_song = np.concatenate(new_song, empty_note)
-                new_song[-1, -1] = Len - totalLen
-            num_notes = new_song.shape[0]
-            new_notes[i, :num_notes] = new_song
-            if return_mask:
-                new_mask[i, :num_notes] = 1
-            pbar.update(1)
+    lengths = (np.asarray(mask) != 0).sum(axis=1)
+    valid = np.arange(Len)[None, :] < lengths[:, None]
+    # a span starts at the first frame of a song, and wherever the notes change
+    start = valid.copy()
+    start[:, 1:] &= (notes[:, 1:] != notes[:, :-1]).any(axis=2)
+
+    song, pos = np.nonzero(start)
+    spans = start.sum(axis=1)
+    offsets = np.append(0, np.cumsum(spans))
+    rank = np.arange(len(song)) - offsets[song]
+    # each span ends where the next one starts, the last one of a song at the end of the song
+    end = np.append(pos[1:], 0)
+    last = offsets[1:][spans > 0] - 1
+    end[last] = lengths[spans > 0]
+
+    new_notes = np.zeros([num_songs, Len, 13], dtype=np.promote_types(notes.dtype, np.int16))
+    new_notes[song, rank, :12] = notes[song, pos]
+    new_notes[song, rank, 12] = end - pos
+    padded = np.nonzero(lengths < Len)[0]
+    new_notes[padded, spans[padded], 12] = Len - lengths[padded]
 
     if return_mask:
+        new_mask = np.zeros([num_songs, Len])
+        new_mask[song, rank] = 1
         return new_notes, new_mask
     else:
         return new_notes
 
 
-def save(ar, basefilename):
-    np.save(ar, basefilename)
+def span_expansion(spans, mask=None):
+    """
+    Inverse of span_formation
+
+    :param spans: (num_songs, Len, 13) new notes of span_formation
+    :param mask: optional new mask of span_formation, to recover the old mask
+    :return: notes (num_songs, Len, 12), and the old mask (num_songs, Len) if mask is given
+    """
+    num_songs, Len = spans.shape[0], spans.shape[1]
+    lens = spans[:, :, 12].astype(int).ravel()
+    # the spans of a song cover exactly Len frames, so the songs stay aligned in the flattened repeat
+    notes = np.repeat(spans[:, :, :12].reshape(-1, 12), lens, axis=0).reshape(num_songs, Len, 12)
+    if mask is None:
+        return notes
+    return notes, np.repeat(np.asarray(mask).ravel(), lens).reshape(num_songs, Len)
+
+
+def convert(job):
+    """
+    Convert one shard, chunk_size songs at a time. The shard is memory-mapped and the outputs written in place,
+    so that neither the packed nor the expanded shard has to fit in memory
+
+    :param job: (directory, number of the shard in index.json, chunk_size)
+    :return: (directory, number of the shard)
+    """
+    path, number, chunk_size = job
+    with open(os.path.join(path, 'index.json')) as f:
+        index = json.load(f)
+    data, _ = load_shard(path, index['shards'][number])
+    num_songs, Len = len(data), index['max_length']
+
+    def output(name, dtype, shape):
+        return np.lib.format.open_memmap(os.path.join(path, '%s_span-%05d.npy' % (name, number)), mode='w+',
+                                         dtype=dtype, shape=shape)
+    melody2 = output('melody', np.int16, (num_songs, Len, 13))
+    chord2 = output('chord', np.int16, (num_songs, Len, 13))
+    sw2 = output('sw', np.float64, (num_songs, Len))
+    for start in range(0, num_songs, chunk_size):
+        end = min(start + chunk_size, num_songs)
+        # songs are cut to max_length when building the shards, so padding to it never cuts them again
+        m, c, mask = data.padded(slice(start, end), length=Len, dtype=np.int16)
+        melody2[start:end], sw2[start:end] = span_formation(m, mask=mask, return_mask=True)
+        chord2[start:end] = span_formation(c, mask=mask)
+    for array in (melody2, chord2, sw2):
+        array.flush()
+    return path, number
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Transform Numpy array of 16th notes into span format')
-    parser.add_argument('files', nargs='+')
+    parser = argparse.ArgumentParser(description='Transform shards of 16th notes into span format')
+    parser.add_argument('directories', nargs='+', help='Shard directories of utils/shards.py')
+    parser.add_argument('--workers', type=int, default=1, help='Number of shards converted at once. Default = 1')
+    parser.add_argument('--chunk_size', type=int, default=1024, help='Songs converted at once. Default = 1024')
     args = parser.parse_args()
 
-    files = args.files
-    files, dir = strip_dirs(files)
-    files = categorize(files)
-
-    path = dir + '/'
-    def join(path, file):
-        return path + file
-
-    for f in files:
-        print "Converting file set %d" % f['index']
-        melody, chord, sample_weights = f['melody'], f['chord'], f['sw']
-        print "Loading files..."
-        m = np.load(path + '/' + melody)
-        c = np.load(path + '/' + chord)
-        sw = np.load(path + '/' + sample_weights)
-        print "Converting melody..."
-        print "Converting chords\n"
-        melody2, sw2 = span_formation(m, mask=sw, return_mask=True)
-        chord2 = span_formation(c, mask=sw)
-
-        save(melody2, '{}/melody_span{}.npy'.format(path, i))
-        save(chord2, '{}/chord_span{}.npy'.format(path, i))
-        save(sw2, '{}/sw_span{}.npy'.format(path, i))
+    jobs = []
+    for path in args.directories:
+        with open(os.path.join(path, 'index.json')) as f:
+            jobs += [(path, number, args.chunk_size) for number in range(len(json.load(f)['shards']))]
+    if args.workers > 1:
+        pool = Pool(args.workers)
+        indexes = pool.imap_unordered(convert, jobs)
+    else:
+        indexes = (convert(job) for job in jobs)
+    for path, number in indexes:
+        print "Converted shard %d of %s" % (number, path)
+    if args.workers > 1:
+        pool.close()
+        pool.join()
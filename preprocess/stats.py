@@ -0,0 +1,96 @@
+"""
+Where the preprocessing time goes, and why files get rejected
+
+A Stats is filled by labelmidi and main.label for one file inside a worker, sent back with the result and merged
+into the run totals, which main.py prints periodically and adds to a JSON report at the end. The report keeps every
+run, so that resuming a run, where most files are up to date, doesn't lose the timings and rejections of the first one.
+"""
+import os
+import time
+import json
+from contextlib import contextmanager
+from collections import defaultdict
+import util
+
+# instrument level codes of labelmidi's ismelody
+CODES = {-10: 'silent', -11: 'overlaps', -12: 'too_many_notes', -13: 'short_play_time', -14: 'same_pitch',
+         -15: 'long_note'}
+
+
+class Stats(object):
+    """
+    Seconds spent per stage and counters, both keyed by name
+    """
+
+    def __init__(self):
+        self.timings = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[stage] += time.time() - start
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def reject(self, reason):
+        self.counts['rejected/' + reason] += 1
+
+    def codes(self, ismelody):
+        for code, name in CODES.items():
+            n = int((ismelody == code).sum())
+            if n:
+                self.counts['instrument/%d_%s' % (code, name)] += n
+
+    def merge(self, other):
+        for stage, seconds in other.timings.items():
+            self.timings[stage] += seconds
+        for name, n in other.counts.items():
+            self.counts[name] += n
+
+    def report(self, elapsed):
+        """
+        :param elapsed: wall clock seconds of the run so far
+        :return: JSON-able dict
+        """
+        files = self.counts['files']
+        return {'elapsed': elapsed,
+                'files': files,
+                'files_per_sec': files / elapsed if elapsed > 0 else 0.,
+                'timings': dict(self.timings),
+                'counts': dict(self.counts)}
+
+    def summary(self, elapsed):
+        """
+        :return: one line for the periodic progress output
+        """
+        files = self.counts['files']
+        stages = ' '.join('%s=%.1fs' % (stage, self.timings[stage]) for stage in sorted(self.timings))
+        rejected = ' '.join('%s=%d' % (name[len('rejected/'):], n) for name, n in sorted(self.counts.items())
+                            if name.startswith('rejected/'))
+        return '# %d files in %.0fs (%.1f files/s), %d accepted, %d up to date | %s | rejected: %s' % (
+            files, elapsed, files / elapsed if elapsed > 0 else 0., self.counts['accepted'], self.counts['uptodate'],
+            stages, rejected)
+
+
+def writereport(stats, elapsed, path):
+    """
+    Add the report of a run to the runs of the report file
+    """
+    runs = []
+    if os.path.exists(path):
+        with open(path) as f:
+            previous = json.load(f)
+        # a report of a single run, written before runs were kept
+        runs = previous['runs'] if 'runs' in previous else [previous]
+    report = stats.report(elapsed)
+    report['finished'] = time.time()
+    runs.append(report)
+    util.makedirs(path)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'runs': runs}, f, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
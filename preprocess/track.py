@@ -3,8 +3,10 @@ import numpy as np
 import glob
 import os
 import util
+import midiscan
+from stats import Stats
 import copy
-
+from collections import namedtuple
 
 
 def getMetadata(pm):
@@ -17,28 +19,171 @@ def getMetadata(pm):
             'end_time': pm.get_end_time(),
             'lyrics': [l.text for l in pm.lyrics]}
 
-def labelmidi(path):
+
+def readmidi(path):
+    """
+    Parse a MIDI file
+
+    :return: (metadata, instruments), instruments are pretty_midi.Instrument
+    """
+    pm = pretty_midi.PrettyMIDI(path)
+    return getMetadata(pm), pm.instruments
+
+
+Notes = namedtuple('Notes', ['start', 'end', 'pitch', 'velocity'])
+
+
+class Song(object):
+    """
+    A MIDI file parsed once by labelmidi and reused by labeltocsv.
+    It carries the note arrays of every instrument and the piano rolls of the non-drum ones at fs
+    """
+
+    def __init__(self, instruments, end_time, fs):
+        self.fs = fs
+        self.end_time = end_time
+        self.programs = np.array([instrument.program for instrument in instruments], dtype=int)
+        self.isdrum = np.array([instrument.is_drum for instrument in instruments], dtype=bool)
+        self.notes = [Notes(start=np.array([note.start for note in instrument.notes], dtype=float),
+                            end=np.array([note.end for note in instrument.notes], dtype=float),
+                            pitch=np.array([note.pitch for note in instrument.notes], dtype=int),
+                            velocity=np.array([note.velocity for note in instrument.notes], dtype=int))
+                      for instrument in instruments]
+        self.piano_rolls = [None if instrument.is_drum else instrument.get_piano_roll(fs=fs)
+                            for instrument in instruments]
+        # number of frames of the whole song, i.e. the width of pm.get_piano_roll(fs)
+        self.beats = max([int(fs*instrument.get_end_time()) if instrument.notes else 0
+                          for instrument in instruments] + [0])
+
+    def __len__(self):
+        return len(self.notes)
+
+    def roll(self, i):
+        """
+        piano roll of the i-th instrument, padded or cut to the length of the song. Drums are all zeros
+        """
+        roll = np.zeros((128, self.beats))
+        if self.piano_rolls[i] is not None:
+            width = min(self.piano_rolls[i].shape[1], self.beats)
+            roll[:, :width] = self.piano_rolls[i][:, :width]
+        return roll
+
+
+def rollstats(piano_rolls):
+    """
+    Piano roll statistics of several instruments, computed in one pass over their stacked piano rolls
+
+    :param piano_rolls: list of n piano rolls, each of shape (128, beats)
+    :return: dict of arrays of shape (n,): beats, lowest, highest (pitch), notecount, pitchsum,
+             overlapcount (notes in frames with 3+ notes), overlap_2 (frames with 2 notes), notetime (frames with notes)
+    """
+    n = len(piano_rolls)
+    beats = np.array([roll.shape[1] for roll in piano_rolls], dtype=int)
+    played = np.zeros((n, 128, beats.max() if n else 0), dtype=bool)
+    for i, roll in enumerate(piano_rolls):
+        played[i, :, :beats[i]] = roll != 0
+    pitchcount = played.sum(axis=2)# frames each pitch is played
+    framecount = played.sum(axis=1)# notes played in each frame
+    used = pitchcount > 0
+    anyused = used.any(axis=1)
+    return {'beats': beats,
+            'lowest': np.where(anyused, np.argmax(used, axis=1), 0),
+            'highest': np.where(anyused, 127 - np.argmax(used[:, ::-1], axis=1), 0),
+            'notecount': pitchcount.sum(axis=1),
+            'pitchsum': pitchcount.dot(np.arange(128)),
+            'overlapcount': np.where(framecount >= 3, framecount, 0).sum(axis=1),
+            'overlap_2': (framecount == 2).sum(axis=1),
+            'notetime': (framecount > 0).sum(axis=1)}
+
+
+def notescore(notes, fs, lastpitch, notecount):
+    """
+    Score melody candidates by walking their notes, all instruments at once.
+    Each instrument starts at 100 and loses (delta-12)*100/notecount for every jump of more than 12 pitches (down to 1).
+    A note longer than 3 measures ends the walk and marks the instrument -15
+
+    :param notes: list of n Notes
+    :param fs: frames per second
+    :param lastpitch: pitch each walk starts from, shape (n,)
+    :param notecount: number of piano roll notes of each instrument, shape (n,)
+    :return: (score (n,), notequantize (n, 49), pitchdeltacount (n, 128))
+    """
+    n = len(notes)
+    lengths = np.array([len(ns.pitch) for ns in notes], dtype=int)
+    offsets = np.append(0, np.cumsum(lengths)[:-1])
+    seg = np.repeat(np.arange(n), lengths)
+    pos = np.arange(len(seg)) - offsets[seg]
+    pitch = np.concatenate([ns.pitch for ns in notes])
+    start = np.concatenate([ns.start for ns in notes])
+    end = np.concatenate([ns.end for ns in notes])
+
+    prevpitch = np.roll(pitch, 1)
+    prevpitch[offsets] = lastpitch
+    notedelta = pitch - prevpitch
+    notelengthquantize = np.round((end - start)*fs).astype(int)
+
+    # the walk stops at the first note longer than 3 measures
+    toolong = notelengthquantize > 48
+    stop = np.minimum.reduceat(np.where(toolong, pos, lengths[seg]), offsets)
+    walked = pos < stop[seg]
+
+    notequantize = np.zeros((n, 49))
+    np.add.at(notequantize, (seg[walked], notelengthquantize[walked]), 1)
+    pitchdeltacount = np.zeros((n, 128))
+    visited = pos <= stop[seg]
+    np.add.at(pitchdeltacount, (seg[visited], np.abs(notedelta[visited])), 1)
+
+    penalty = np.where(notedelta > 12, (notedelta - 12)*100 // notecount[seg], 0)#score down if notes cross 12 pitch
+    score = np.maximum(100 - np.bincount(seg, weights=penalty, minlength=n), 1)
+    score[stop < lengths] = -15# note longer than 3 measures -15
+    return score, notequantize, pitchdeltacount
+
+def labelmidi(path, notecache=None, digest=None, runstats=None):
+    """
+    Score every instrument of a MIDI file as melody (highest score), bass (-1), drum (-2) or chord (anything else)
+
+    :param notecache: optional cache.NoteCache, to skip parsing files that were already parsed once
+    :param digest: content hash of the file, needed with notecache
+    :param runstats: optional stats.Stats, to record the time of each stage and the rejection reasons
+    :return: (available, label, song). song is the parsed Song, to be passed on to labeltocsv
+    """
+    if runstats is None:
+        runstats = Stats()
+    # most files fail the metadata checks below, which midiscan can do without parsing the file
+    with runstats.time('metadata'):
+        reason = midiscan.reject(midiscan.scan(path))
+    if reason:
+        runstats.count('scan_rejected')
+        runstats.reject(reason)
+        return False, [], None
     try:
-        pm = pretty_midi.PrettyMIDI(path)
-        metadata = getMetadata(pm)
+        with runstats.time('parse'):
+            if notecache is None:
+                metadata, instruments = readmidi(path)
+            else:
+                metadata, instruments = notecache.readmidi(path, digest)
     except Exception as e:
         print(e)
-        return False, []
+        runstats.reject('parse_error')
+        return False, [], None
     #print "loaded"
     estimated_tempo = 0
     # if change time_signature or no time_signature, skip this MIDI
     if len(metadata['time_signature_changes']) != 1:
         #print "no time signature"
         #estimated_tempo = pm.estimate_tempo()
-        return False, []
+        runstats.reject('time_signature')
+        return False, [], None
     # if there are tempo changes, skip this MIDI
     elif len(metadata['tempos']) != 1:
         #print "tempo changes"
-        return False, []
+        runstats.reject('tempo')
+        return False, [], None
     # if there are less than 2 tracks, skip this MIDI
     if metadata['n_instruments'] < 2:
         #print "one track"
-        return False, []
+        runstats.reject('instrument_count')
+        return False, [], None
     # since there are many MIDIs without key label, we won't pre-process them.
     # Thus, we should be able to accompany songs with key changes
     tempo = 0
@@ -47,118 +192,79 @@ def labelmidi(path):
     else:
         tempo = estimated_tempo
     fs = tempo/15 #1/(time per 16 beat)
-    #print path, "is available midi with", len(pm.instruments), "instruments. Tempo=", tempo
+    #print path, "is available midi with", len(instruments), "instruments. Tempo=", tempo
+
+    with runstats.time('piano_roll'):
+        song = Song(instruments, metadata['end_time'], fs)
+    with runstats.time('scoring'):
+        available, ismelody = scoresong(song, fs, runstats)
+    if available:
+        return True, ismelody, song
+    else:
+        runstats.reject('no_melody')
+        return False, [], None
+
+
+def scoresong(song, fs, runstats):
+    """
+    The scoring part of labelmidi
 
-    instrument_num = len(pm.instruments)
-    ins_score = np.zeros(instrument_num)
+    :param runstats: stats.Stats, counts the instruments rejected as melody by code
+    :return: (whether an instrument scored as melody, ismelody)
+    """
+    instrument_num = len(song)
     ismelody = np.ones(instrument_num, dtype=float)*100#0 for definitely not, -1 for bass, -2 for drum
     pitchrange = np.zeros(instrument_num)
     pitchmean = np.ones(instrument_num, dtype=float)*128
-    pitchdeltasum = np.zeros(instrument_num)
     pitchdeltacount = np.zeros((instrument_num, 128))
     notetimesum = np.zeros(instrument_num)
     notequantize = np.zeros((instrument_num, 49))
     noteoverlap_2 = np.zeros(instrument_num)
     beats = 0
 
-    #chord = set()
-    #melody = set()
-    for i in xrange(len(pm.instruments)):
-        instrument = pm.instruments[i]
-        #print "instrument", i
-        if instrument.is_drum == True:
-            ismelody[i] = -2
-            continue
-
-        piano_roll = instrument.get_piano_roll(fs=fs)#piano_roll
-        beats = piano_roll.shape[1]
-        lowest_pitch = 0
-        highest_pitch = 0
-        for p in xrange(128):#lowest pitch
-            if np.count_nonzero(piano_roll[p]):
-                lowest_pitch = p
-                break
-        for p in reversed(xrange(128)):#highest pitch
-            if np.count_nonzero(piano_roll[p]):
-                highest_pitch = p
-                break
-        pitchrange[i] = highest_pitch - lowest_pitch
-        #print "pitch range = ", pitchrange[i],
-
-
-        notecount = 0
-        pitchsum = 0
-        overlapcount = 0
-        for b in xrange(beats):
-            for p in xrange(128):
-                if piano_roll[p][b]:
-                    notecount += 1
-                    pitchsum += p
-            if np.count_nonzero(piano_roll[:, b])>=3:#three notes overlaps
-                overlapcount += np.count_nonzero(piano_roll[:, b])
-            if np.count_nonzero(piano_roll[:, b])==2:#two notes overlaps
-                noteoverlap_2[i] += 1
-            if any(piano_roll[:, b]):
-                notetimesum[i] += 1
-        if notecount:#if there is note -10
-            pitchmean[i] = pitchsum/notecount
-        else:
-            ismelody[i] = -10
-            break
-        #print "mean pitch = ", pitchmean[i], "notes:", notecount,
-        #print "total beats:", notetimesum[i], "(", notetimesum[i]*100/beats, "%)"
-
-        if overlapcount/float(notecount) > 0.1:#total overlaps should be under 10% -11
-            ismelody[i] = -11
-        if notecount > notetimesum[i]*2: # too many notes -12
-            ismelody[i] = -12
-        if notetimesum[i]/beats<0.3:#play time under 30% -13
-            ismelody[i] = -13
-        if pitchrange[i] == 0:#same pitch ever -14
-            ismelody[i] = -14
-
-
-        if ismelody[i]>0:
-            prevNoteStartTime = 0
-            prevNoteEndTime = 0
-
-            lastpitch = int(pitchmean[i])
-            for note in instrument.notes:#notes lined by end time
-                #print note, "    ", note.start - prevNoteStartTime
-
-                notedelta = note.pitch-lastpitch
-                #print notedelta
-                pitchdeltasum += abs(notedelta)
-                pitchdeltacount[i][abs(notedelta)] += 1
-                lastpitch = note.pitch
-                notedis = note.start - prevNoteStartTime
-                noterest = note.start - prevNoteEndTime
-                notelength = note.end - note.start
-                notelengthquantize = int(np.round(notelength*fs))
-                if notelengthquantize > 48:# note longer than 3 measures -15
-                    ismelody[i] = -15
-                else:
-                    notequantize[i][notelengthquantize] += 1
-                if ismelody[i] > 0:
-                    if notedelta > 12:#score down if notes cross 12 pitch
-                        ismelody[i] -= (notedelta-12)*100/notecount
-                        if ismelody[i]<1:
-                            ismelody[i]=1
-                else:
-                    break
-
-                prevNoteStartTime = note.start
-                prevNoteEndTime = note.end
-            #if ismelody[i]:
-            #    print pitchdeltacount[i]
-            else: continue
-
-
-        #util.writecsv(piano_roll, "piano_roll.csv")
-        #break
+    isdrum = song.isdrum.copy()
+    tonal = np.nonzero(~isdrum)[0]
+    stats = rollstats([song.piano_rolls[i] for i in tonal])
+
+    # the first instrument without notes is marked -10 and stops the scan,
+    # so the instruments after it are left unscored
+    silent = np.nonzero(stats['notecount'] == 0)[0]
+    if len(silent):
+        tonal, stats = tonal[:silent[0]+1], {k: v[:silent[0]+1] for k, v in stats.items()}
+        ismelody[tonal[-1]] = -10
+        isdrum[tonal[-1]:] = False
+    ismelody[isdrum] = -2
+    if len(tonal):
+        beats = stats['beats'][-1]
+    pitchrange[tonal] = stats['highest'] - stats['lowest']
+    notetimesum[tonal] = stats['notetime']
+    noteoverlap_2[tonal] = stats['overlap_2']
+    if len(silent):
+        tonal, stats = tonal[:-1], {k: v[:-1] for k, v in stats.items()}
+
+    notecount = stats['notecount']
+    pitchmean[tonal] = stats['pitchsum'] // notecount
+    score = np.ones(len(tonal), dtype=float)*100
+    score[stats['overlapcount']/notecount.astype(float) > 0.1] = -11#total overlaps should be under 10% -11
+    score[notecount > stats['notetime']*2] = -12# too many notes -12
+    score[stats['notetime']/stats['beats'].astype(float) < 0.3] = -13#play time under 30% -13
+    score[stats['highest'] == stats['lowest']] = -14#same pitch ever -14
+    ismelody[tonal] = score
+
+    candidates = tonal[score > 0]
+    if len(candidates):
+        notes = [song.notes[i] for i in candidates]#notes lined by end time
+        score, quantize, deltacount = notescore(notes, fs, pitchmean[candidates].astype(int),
+                                                notecount[score > 0])
+        ismelody[candidates] = score
+        notequantize[candidates] = quantize
+        pitchdeltacount[candidates] = deltacount
+
+    runstats.codes(ismelody)
+
     bassflag = True
     for ba in xrange(instrument_num):
-        if 33<= pm.instruments[ba].program <=40 or pitchmean[ba] <= 40:
+        if 33<= song.programs[ba] <=40 or pitchmean[ba] <= 40:
             ismelody[ba] = -1
             bassflag = False
     if bassflag:
@@ -204,11 +310,7 @@ def labelmidi(path):
 
     #"""
     #break
-    if any(ismelody>0):
-        #print np.argmax(ismelody), ismelody.astype(int)
-        return True, ismelody
-    else:
-        return False, []
+    return any(ismelody>0), ismelody
 
     # TODO: try to get the minimal time unit, and parse MIDI into song structure.
 
@@ -220,32 +322,52 @@ def labelmidi(path):
     # print pm.get_downbeats()
     # print pm.get_beats()
     # pm.estimate_beat_start()
-def labeltocsv(directory, path, label):
-    pm = pretty_midi.PrettyMIDI(directory+path)
-    metadata = getMetadata(pm)
-    tempo = metadata['tempos'][0]
-    fs = tempo/15
-    piano_roll = pm.get_piano_roll(fs=fs)#piano_roll
-    beats = piano_roll.shape[1]
-    end = pm.get_end_time()
+def labeltracks(song, label):
+    """
+    Split a song labeled by labelmidi into its melody, chord and bass tracks
+
+    :param song: the Song returned by labelmidi
+    :param label: the label returned by labelmidi
+    :return: (melody, chord, bass), piano rolls of shape (128, song.beats)
+    """
+    beats = song.beats
     melody = np.zeros((128, beats))
     chord = np.zeros((128, beats))
     bass = np.zeros((128, beats))
 
-    for i in xrange(len(pm.instruments)):
+    for i in xrange(len(song)):
         if label[i] == np.max(label):
-            melody = pm.instruments[i].get_piano_roll(times=np.arange(0, end, 1./fs))
+            melody = song.roll(i)
         elif label[i] == -1:
-            tmp = pm.instruments[i].get_piano_roll(times=np.arange(0, end, 1./fs))[:, :beats]
-            if tmp.shape == bass.shape:
-                bass += tmp
+            bass += song.roll(i)
         elif label[i] == -2:
             pass
         else:
-            tmp = pm.instruments[i].get_piano_roll(times=np.arange(0, end, 1./fs))[:, :beats]
-            if tmp.shape == chord.shape:
-                chord += tmp
+            chord += song.roll(i)
+    return melody, chord, bass
+
+
+def labeltocsv(song, path, label):
+    """
+    Write the tracks of a labeled song to midilabel/{melody,chord,bass}/ as dense CSV
+
+    :param path: path of the MIDI file, relative to the corpus directory
+    :return: paths of the written files
+    """
+    outputs = ["midilabel/"+name+"/"+path[:-3]+"csv" for name in ('melody', 'chord', 'bass')]
+    for track, output in zip(labeltracks(song, label), outputs):
+        util.writecsv(track, output)
+    return outputs
+
 
-    util.writecsv(melody, "midilabel/melody/"+path[:-3]+"csv")
-    util.writecsv(chord, "midilabel/chord/"+path[:-3]+"csv")
-    util.writecsv(bass, "midilabel/bass/"+path[:-3]+"csv")
+def labeltonpz(song, path, label):
+    """
+    Write the tracks of a labeled song to midilabel/{melody,chord,bass}/ in the sparse .npz format
+
+    :param path: path of the MIDI file, relative to the corpus directory
+    :return: paths of the written files
+    """
+    outputs = ["midilabel/"+name+"/"+path[:-3]+"npz" for name in ('melody', 'chord', 'bass')]
+    for track, output in zip(labeltracks(song, label), outputs):
+        util.writenpz(track, output)
+    return outputs
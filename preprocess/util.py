@@ -39,11 +39,38 @@ import errno
 #         pygame.mixer.music.stop()
 #         raise SystemExit
 
-def writecsv(a, path):
-    if not os.path.exists(os.path.dirname(path[:path.rfind('/')+1])):
+def makedirs(path):
+    directory = path[:path.rfind('/')+1]
+    if directory and not os.path.exists(directory):
         try:
-            os.makedirs(path[:path.rfind('/')+1])
+            os.makedirs(directory)
         except OSError as exc:  # Python >2.5
             if exc.errno != errno.EEXIST:
                 raise
-    np.savetxt(path, a, fmt='%i', delimiter=',')
\ No newline at end of file
+
+
+def writecsv(a, path):
+    makedirs(path)
+    np.savetxt(path, a, fmt='%i', delimiter=',')
+
+
+def writenpz(a, path):
+    """
+    Store a piano roll as its runs of constant velocity. See utils/midilabel.py for the format.
+    Velocities are truncated to integers, like writecsv does
+    """
+    makedirs(path)
+    a = a.astype(int)
+    padded = np.zeros((a.shape[0], a.shape[1] + 2), dtype=int)
+    padded[:, 1:-1] = a
+    # a run of pitch p spans the columns between two consecutive changes of row p
+    pitch, change = np.nonzero(padded[:, 1:] != padded[:, :-1])
+    samerow = pitch[:-1] == pitch[1:]
+    pitch, onset, offset = pitch[:-1][samerow], change[:-1][samerow], change[1:][samerow]
+    velocity = a[pitch, onset]
+    played = velocity != 0
+    np.savez_compressed(path, shape=np.array(a.shape),
+                        pitch=pitch[played].astype(np.uint8),
+                        onset=onset[played].astype(np.int32),
+                        offset=offset[played].astype(np.int32),
+                        velocity=velocity[played].astype(np.int32))
@@ -0,0 +1,244 @@
+"""
+Spread the labeling of preprocess/main.py over several machines that mount the same corpus and working directory
+
+The machines coordinate through a queue directory on the shared filesystem only:
+- pending/<shard>: MIDI files of a shard (paths relative to the corpus directory), waiting for a worker
+- claimed/<shard>@<worker>: a shard being labeled. A worker claims a shard by renaming it out of pending/ to a
+  name of its own, which only one worker can do, and keeps touching it while it works. A claim that hasn't been
+  touched for --timeout seconds belongs to a dead worker and is moved back to pending/. A stalled worker that
+  finishes after that only removes its own claim, not the one of the worker that claimed the shard again
+- done/<shard>.json: counts, stage timings and new manifest entries of a labeled shard
+
+Run `init` once, `work` on every machine (from the same working directory, where midilabel/ is written),
+and `merge` once all shards are done to update the manifest and print the summary.
+"""
+import os
+import json
+import time
+import errno
+import socket
+import argparse
+import itertools
+import threading
+from multiprocessing import Pool
+import cache
+import main
+from stats import Stats, writereport
+
+
+def makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def writeatomic(path, contents):
+    tmp = '%s.%s-%d.tmp' % (path, socket.gethostname(), os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(contents)
+    os.rename(tmp, path)
+
+
+def workername():
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+def servertime(queue):
+    """
+    Current time of the shared filesystem, so that heartbeats of machines with skewed clocks compare fine
+    """
+    clock = os.path.join(queue, 'clock', workername())
+    with open(clock, 'a'):
+        os.utime(clock, None)
+    return os.stat(clock).st_mtime
+
+
+def init(args):
+    for sub in ('pending', 'claimed', 'done', 'clock'):
+        makedirs(os.path.join(args.queue, sub))
+    if any(os.listdir(os.path.join(args.queue, sub)) for sub in ('pending', 'claimed', 'done')):
+        raise ValueError('Queue %s is not empty' % args.queue)
+
+    paths = (path[len(args.directory):] for path in main.listmidi(args.directory))
+    shardcount = 0
+    while True:
+        shard = list(itertools.islice(paths, args.shard_size))
+        if not shard:
+            break
+        writeatomic(os.path.join(args.queue, 'pending', '%06d' % shardcount), '\n'.join(shard) + '\n')
+        shardcount += 1
+    print "Wrote %d shards of up to %d files to %s" % (shardcount, args.shard_size, args.queue)
+
+
+def claim(queue, timeout):
+    """
+    :return: (shard, path of the claim) of a shard now owned by this worker, None if there is nothing left to
+             claim, or '' if the remaining shards are owned by live workers
+    """
+    pending, claimed = os.path.join(queue, 'pending'), os.path.join(queue, 'claimed')
+    for shard in sorted(os.listdir(pending)):
+        path = os.path.join(claimed, '%s@%s' % (shard, workername()))
+        try:
+            os.rename(os.path.join(pending, shard), path)
+        except OSError:
+            # claimed by another worker in the meantime
+            continue
+        os.utime(path, None)
+        return shard, path
+
+    claims = sorted(os.listdir(claimed))
+    now = servertime(queue)
+    for name in claims:
+        try:
+            if now - os.stat(os.path.join(claimed, name)).st_mtime > timeout:
+                shard = name.split('@', 1)[0]
+                print "Reclaiming stalled shard %s" % shard
+                os.rename(os.path.join(claimed, name), os.path.join(pending, shard))
+        except OSError:
+            # finished or reclaimed by another worker in the meantime
+            continue
+    return '' if claims else None
+
+
+class Heartbeat(threading.Thread):
+    """
+    Touches a claimed shard every interval seconds until stopped
+    """
+
+    def __init__(self, path, interval):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                # reclaimed by another worker, which will redo the shard
+                pass
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def work(args):
+    entries, _ = cache.readmanifest(args.manifest)
+    cachedir = None if args.no_cache else args.cache
+    pool = Pool(args.workers) if args.workers > 1 else None
+    while True:
+        claimed = claim(args.queue, args.timeout)
+        if claimed is None:
+            break
+        if claimed == '':
+            time.sleep(args.timeout / 4.)
+            continue
+
+        shard, claimed = claimed
+        heartbeat = Heartbeat(claimed, args.timeout / 4.)
+        heartbeat.start()
+        with open(claimed) as f:
+            localpaths = f.read().splitlines()
+        print "Labeling shard %s (%d files)" % (shard, len(localpaths))
+        jobs = ((args.directory, args.directory + localpath, args.format, entries.get(localpath), cachedir)
+                for localpath in localpaths)
+        if pool is not None:
+            results = main.imap_bounded(pool, main.label, jobs, 4 * args.workers)
+        else:
+            results = itertools.imap(main.label, jobs)
+
+        started = servertime(args.queue)
+        new_entries = []
+        available = []
+        totals = Stats()
+        for entry, new, runstats in results:
+            if new:
+                new_entries.append(entry)
+            if entry['available']:
+                available.append(entry['path'])
+            totals.merge(runstats)
+        writeatomic(os.path.join(args.queue, 'done', shard + '.json'),
+                    json.dumps({'pathcount': len(localpaths), 'available': available, 'entries': new_entries,
+                                'started': started, 'finished': servertime(args.queue),
+                                'timings': totals.timings, 'counts': totals.counts}))
+        heartbeat.stop()
+        try:
+            # only this worker's claim: if the shard was reclaimed, another worker may own it under its own name
+            os.remove(claimed)
+        except OSError:
+            pass
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def merge(args):
+    left = [shard for sub in ('pending', 'claimed') for shard in os.listdir(os.path.join(args.queue, sub))]
+    if left:
+        print "Warning: %d shards are not done yet" % len(left)
+
+    manifest = cache.Manifest(args.manifest)
+    pathcount = 0
+    availablepathcount = 0
+    totals = Stats()
+    started, finished = [], []
+    done = os.path.join(args.queue, 'done')
+    for result in sorted(os.listdir(done)):
+        if not result.endswith('.json'):
+            continue
+        with open(os.path.join(done, result)) as f:
+            result = json.load(f)
+        for entry in result['entries']:
+            manifest.add(entry)
+        pathcount += result['pathcount']
+        availablepathcount += len(result['available'])
+        shardstats = Stats()
+        shardstats.timings.update(result['timings'])
+        shardstats.counts.update(result['counts'])
+        totals.merge(shardstats)
+        started.append(result['started'])
+        finished.append(result['finished'])
+    manifest.close()
+    # wall clock time from the first shard started to the last one finished, over all machines
+    elapsed = max(finished) - min(started) if started else 0.
+    print totals.summary(elapsed)
+    writereport(totals, elapsed, args.report)
+    print availablepathcount, "/", pathcount
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Label a MIDI corpus with workers on several machines, '
+                                                 'through a queue directory on a shared filesystem')
+    parser.add_argument('--queue', default='midilabel/queue', help='Queue directory. Default = midilabel/queue')
+    parser.add_argument('--manifest', default='midilabel/manifest.jsonl', help='Default = midilabel/manifest.jsonl')
+    subparsers = parser.add_subparsers()
+
+    parser_init = subparsers.add_parser('init', help='Split the corpus into shards')
+    parser_init.add_argument('directory', nargs='?', default='.', help='Default = .')
+    parser_init.add_argument('--shard_size', type=int, default=500, help='Files per shard. Default = 500')
+    parser_init.set_defaults(func=init)
+
+    parser_work = subparsers.add_parser('work', help='Label shards until none is left')
+    parser_work.add_argument('directory', nargs='?', default='.', help='Default = .')
+    parser_work.add_argument('--workers', type=int, default=1, help='Number of labeling processes. Default = 1')
+    parser_work.add_argument('--format', choices=sorted(main.writers), default='npz', help='Default = npz')
+    parser_work.add_argument('--cache', default='notecache', help='Default = notecache')
+    parser_work.add_argument('--no_cache', dest='no_cache', action='store_true')
+    parser_work.add_argument('--timeout', type=float, default=600,
+                             help='Seconds without heartbeat after which a claimed shard is reclaimed. Default = 600')
+    parser_work.set_defaults(func=work)
+
+    parser_merge = subparsers.add_parser('merge', help='Add the results of all shards to the manifest')
+    parser_merge.add_argument('--report', default='midilabel/report.json',
+                              help='JSON report of the stage timings and rejection counts, each merge is added to it. '
+                                   'Default = midilabel/report.json')
+    parser_merge.set_defaults(func=merge)
+
+    args = parser.parse_args()
+    args.func(args)
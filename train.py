@@ -18,7 +18,17 @@ if __name__ == "__main__":
     parser.add_argument('--dropout_rate', nargs='?', type=float)
     parser.add_argument('--batch_size', nargs='?', type=int)
     parser.add_argument('--nb_test', nargs='?', type=int)
+    parser.add_argument('--dataset', nargs='?', choices=('csv', 'big'))  # csv/ songs or the MIDI corpus shards
+    parser.add_argument('--max_length', nargs='?', type=int)  # songs of the big dataset are cut to max_length
+    parser.add_argument('--negatives', nargs='?', type=int)  # negative pairs per song, for pair
+    parser.add_argument('--augment', nargs='?', choices=sorted(AUGMENTATIONS))  # transpose train batches
+    parser.add_argument('--bucket', dest='bucket', action='store_true')  # batch songs of similar lengths, masked
+    parser.add_argument('--prefetch', nargs='?', type=int)  # batches prepared ahead of training
+    parser.add_argument('--prefetch_workers', nargs='?', type=int)  # threads preparing them
     parser.add_argument('--debug', dest='debug', action='store_true')  # debug flag
+    parser.add_argument('--dedup', dest='dedup', action='store_true')  # drop near-duplicate songs
+    parser.add_argument('--drop_flagged', nargs='*', choices=VALIDATION_CHECKS, default=[],
+                        help='Drop the songs failing these validation checks')
 
     args = parser.parse_args()
     args.strategy = args.strategy if args.strategy else 'pair'
@@ -27,8 +37,14 @@ if __name__ == "__main__":
     args.nodes2 = args.nodes2 if args.nodes2 else 0
     args.nb_epoch = args.nb_epoch if args.nb_epoch else 10
     args.nb_test = args.nb_test if args.nb_test else 100
+    args.dataset = args.dataset if args.dataset else 'csv'
+    args.max_length = args.max_length if args.max_length else 1024
+    args.negatives = args.negatives if args.negatives else 1
+    args.augment = args.augment if args.augment else 'none'
     args.dropout_rate = args.dropout_rate if args.dropout_rate else 0.5
     args.batch_size = args.batch_size if args.batch_size else 20
+    args.prefetch = args.prefetch if args.prefetch else 8
+    args.prefetch_workers = args.prefetch_workers if args.prefetch_workers else 2
     args.mtl_ratio = args.mtl_ratio if args.mtl_ratio else 1.0
     print args
 
@@ -36,5 +52,6 @@ if __name__ == "__main__":
     ts = strategies[args.strategy](args)
     if args.strategy == 'LM':
         args.one_hot_dim = ts.ydim
-    model = build_model(args, args.nodes1, args.nodes2, args.dropout_rate, ts.seq_len)
+    # bucketed batches have different lengths
+    model = build_model(args, args.nodes1, args.nodes2, args.dropout_rate, None if args.bucket else ts.seq_len)
     ts.train(model)
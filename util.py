@@ -4,6 +4,8 @@ import numpy as np
 import pretty_midi
 import csv
 from utils.build_chord_repr import *
+from utils.shards import build_shards
+from multiprocessing import cpu_count
 
 
 def rotate(Chroma, semitone):
@@ -83,22 +85,42 @@ def chroma2chord_v1(chroma):
     return [0, 0]
 
 
+_chroma2chord_table = None
+
+
+def chroma2chord_batch(chromas):
+    """
+    chroma2chord_v2 of many chromas at once, through a table of the 4096 possible chromas
+
+    :param chromas: (n, 12)
+    :return: (roots, types), arrays of shape (n,)
+    """
+    global _chroma2chord_table
+    if _chroma2chord_table is None:
+        bits = (np.arange(4096)[:, None] >> np.arange(12)) & 1
+        _chroma2chord_table = np.array([chroma2chord_v2(chroma) for chroma in bits], dtype=int)
+    index = (np.asarray(chromas) > 0).dot(1 << np.arange(12))
+    return _chroma2chord_table[index, 0], _chroma2chord_table[index, 1]
+
+
 def isChord(notes):
+    """
+    Group notes by onset and offset, without modifying notes
+
+    :param notes: pretty_midi notes of an instrument
+    :return: the groups of notes (lists sorted by onset), or False if any group has less than 2 notes
+    """
     if len(notes) < 2:
         return False
-    chord_list = []
-    while len(notes) >= 2:
-        if notes[0].start != notes[1].start or notes[0].end != notes[1].end:
-            return False
-        chord = []
-        while len(notes) >= 2 and notes[0].start == notes[1].start and notes[0].end == notes[1].end:
-            chord.append(notes[0])
-            del notes[0]
-        chord.append(notes[0])
-        del notes[0]
-        chord_list.append(chord)
-    # assert len(notes) == 0
-    return chord_list
+    start = np.array([note.start for note in notes])
+    end = np.array([note.end for note in notes])
+    order = np.lexsort((end, start))
+    start, end = start[order], end[order]
+    boundaries = np.flatnonzero((start[1:] != start[:-1]) | (end[1:] != end[:-1])) + 1
+    bounds = np.concatenate(([0], boundaries, [len(notes)]))
+    if np.any(np.diff(bounds) < 2):
+        return False
+    return [[notes[i] for i in order[a:b]] for a, b in zip(bounds[:-1], bounds[1:])]
 
 _qualifier = {
     1: 'Maj', 2: 'Min', 3: 'Maj7', 4: '7', 5: 'Min7'
@@ -173,41 +195,12 @@ def toCandidateBestN(CP, allCP, bestN):
     return bestIdx
 
 
-def csv2npy():
-    max_length = 1024
+def csv2npy(max_length=1024, workers=cpu_count()):
     for j in range(4, 7):
-        nb_train = sum([len(files) for r, d, files in os.walk("../dataset_bk/melody/part" + str(j))])
-        C = np.zeros((nb_train, max_length, 12))
-        M = np.zeros((nb_train, max_length, 12))
-        sample_weight = np.zeros((nb_train, max_length))
-        train_idx = 0
-        for root, _, files in os.walk("../dataset_bk/melody/part" + str(j)):
-            for m_file_name in files:
-                m_file_name_path = os.path.join(root, m_file_name)
-                c_file_name_path = m_file_name_path.replace("/melody/", "/chord/", 1)
-                m_file_matrix = np.genfromtxt(m_file_name_path, delimiter=',')
-                c_file_matrix = np.genfromtxt(c_file_name_path, delimiter=',')
-                if len(m_file_matrix) == 0 or len(c_file_matrix) == 0: continue
-                m_file_matrix = m_file_matrix[:, :max_length]
-                c_file_matrix = c_file_matrix[:, :max_length]
-                seq_len = min(m_file_matrix.shape[1], c_file_matrix.shape[1])
-                tmp_m, tmp_c = np.zeros((12, seq_len)), np.zeros((12, seq_len))
-                for i in range(128 / 12):
-                    tmp_m = np.logical_or(tmp_m, m_file_matrix[i * 12:(i + 1) * 12, :seq_len])
-                    tmp_c = np.logical_or(tmp_c, c_file_matrix[i * 12:(i + 1) * 12, :seq_len])
-                sample_weight[train_idx, :seq_len] = np.ones((1, seq_len))
-                M[train_idx, :seq_len], C[train_idx, :seq_len] = np.swapaxes(tmp_m, 0, 1), np.swapaxes(tmp_c, 0, 1)
-                train_idx += 1
-        C = C[:train_idx]
-        M = M[:train_idx]
-        sample_weight = sample_weight[:train_idx]
-        print C.shape
-        print M.shape
-        print sample_weight.shape
-        np.save('~/npy/chord_csv' + str(j) + '.npy', C.astype(int))
-        np.save('~/npy/melody_csv' + str(j) + '.npy', M.astype(int))
-        np.save('~/npy/sw_csv' + str(j) + '.npy', sample_weight.astype(int))
-        print("saving csv" + str(j) + ".npy")
+        directory = os.path.expanduser('~/npy/csv' + str(j))
+        # the corpus has no key information, transpose the songs to C major from their estimated key
+        n = build_shards("../dataset_bk/melody/part" + str(j), directory, max_length, workers=workers)
+        print("saving %d songs of part %d to %s" % (n, j, directory))
 
 
 def print_result(pred, y, Y, alg, bestN, printCP=False, verbose=False):
@@ -230,7 +223,7 @@ def print_result(pred, y, Y, alg, bestN, printCP=False, verbose=False):
 class LUT(object):
     def __init__(self, name, _list):
         self.__name__ = name
-        self._list = list
+        self._list = _list
         assert len(_list) > 0
         self._dict = {x: i for i, x in enumerate(_list)}
 
@@ -368,10 +361,9 @@ def rotateNotes(C, semitone):
     return np.concatenate((C[:,:,-semitone:], C[:,:,:12-semitone]), axis=2)
 
 def dataAug(C):
-    newC = C+0
-    for i in range(11):
-        newC = np.concatenate((newC, rotateNotes(C, i+1)), axis=0)
-    return newC
+    # the 12 rotations at once: newC[i*n + k] = rotateNotes(C, i)[k]
+    index = (np.arange(12)[None, :] - np.arange(12)[:, None]) % 12
+    return np.concatenate([C[:, :, index[i]] for i in range(12)], axis=0)
 
 def smooth_v2(M, C):
     """
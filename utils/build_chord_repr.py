@@ -30,7 +30,8 @@ class ChordNotes2OneHotTranscoder(object):
         # packbits assumes numbers are in 8 bits. Instead our data uses 12 bits
         # therefore it is necessary to do the bit operaation below:
         indexes = (indexes[:, 0] << 4) + (indexes[:, 1] >> 4)
-        chord_indexes = [self.sign2chord[i] for i in indexes]
+        # chords missing from the csv/ signatures (e.g. in the big dataset) become the empty chord
+        chord_indexes = [self.sign2chord.get(i, 0) for i in indexes]
         new_chord[np.arange(n), chord_indexes] = 1
         new_chord = new_chord.reshape([chord.shape[0], chord.shape[1], self.size])
         return new_chord
@@ -0,0 +1,149 @@
+"""
+Find near-duplicate songs with MinHash and locality sensitive hashing
+
+A song is the set of its shingles, runs of SHINGLE consecutive frames of melody and chord notes. Two songs are
+near-duplicates when the Jaccard similarity of their shingle sets is above a threshold. MinHash signatures estimate
+that similarity, and LSH buckets the signatures band by band so that only songs sharing a bucket are compared,
+instead of all pairs.
+
+Songs are either dense (nb_song, T, 12) arrays or the bit-packed (nb_song, T) codes of the csv/cache/ arrays of
+load_data.parse_data_compact, which are unpacked chunk by chunk.
+
+Usage: python utils/dedup.py csv/cache/normal-<digest>-melody.npy csv/cache/normal-<digest>-chord.npy
+                             --sw csv/cache/normal-<digest>-sampleweight.npy --report csv/duplicates.json
+"""
+import json
+import argparse
+import numpy as np
+from packed import unpack_chroma, unpack_melody
+
+SHINGLE = 8
+# MinHash hash functions (a * x + b) mod PRIME, on shingles hashed to [0, PRIME)
+PRIME = (1 << 31) - 1
+
+
+def shingles(M, C, sw=None):
+    """
+    :param M: melody (nb_song, T, 12)
+    :param C: chord (nb_song, T, 12)
+    :param sw: optional sample weight (nb_song, T), frames of weight 0 are padding
+    :return: (hashes, offsets), hashes of the shingles of song i are hashes[offsets[i]:offsets[i+1]]
+    """
+    nb_song, length = M.shape[:2]
+    # one 24 bit integer per frame
+    frames = (np.concatenate((M, C), axis=2) > 0).dot(1 << np.arange(24, dtype=np.int64))
+    valid = np.ones((nb_song, length), dtype=bool) if sw is None else sw > 0
+    width = max(length - SHINGLE + 1, 0)
+    # polynomial hash of each window of SHINGLE frames, all windows at once
+    hashes = np.zeros((nb_song, width), dtype=np.int64)
+    complete = np.ones((nb_song, width), dtype=bool)
+    for k in range(SHINGLE):
+        hashes = (hashes * 16777259 + frames[:, k:k + width]) % PRIME
+        complete &= valid[:, k:k + width]
+    counts = complete.sum(axis=1)
+    return hashes[complete], np.append(0, np.cumsum(counts))
+
+
+def minhash(hashes, offsets, num_perm=128, seed=1, batch=1 << 22):
+    """
+    :return: (nb_song, num_perm) signatures. Songs without any shingle get PRIME everywhere
+    """
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, PRIME, size=num_perm).astype(np.int64)
+    b = rng.randint(0, PRIME, size=num_perm).astype(np.int64)
+    nb_song = len(offsets) - 1
+    signatures = np.full((nb_song, num_perm), PRIME, dtype=np.int64)
+    counts = np.diff(offsets)
+    nonempty = np.nonzero(counts)[0]
+    # songs in chunks of about batch shingles, so that the (num_perm, shingles) products fit in memory
+    start = 0
+    while start < len(nonempty):
+        end = start + 1
+        while end < len(nonempty) and offsets[nonempty[end] + 1] - offsets[nonempty[start]] <= batch // num_perm:
+            end += 1
+        songs = nonempty[start:end]
+        chunk = hashes[offsets[songs[0]]:offsets[songs[-1] + 1]]
+        permuted = (a[:, None] * chunk[None, :] + b[:, None]) % PRIME
+        signatures[songs] = np.minimum.reduceat(permuted, offsets[songs] - offsets[songs[0]], axis=1).T
+        start = end
+    return signatures
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def lsh_clusters(signatures, bands=16, threshold=0.7):
+    """
+    Group songs whose signatures share a band, and whose estimated Jaccard similarity is above threshold
+
+    :return: list of clusters of at least 2 song indexes, each sorted
+    """
+    nb_song, num_perm = signatures.shape
+    rows = num_perm // bands
+    parent = np.arange(nb_song)
+    candidates = np.nonzero((signatures != PRIME).any(axis=1))[0]
+    position = np.arange(len(candidates))
+    mix = np.random.RandomState(0).randint(1, PRIME, size=rows).astype(np.int64)
+    for band in range(bands):
+        # one key per band, overflow just wraps. Colliding keys are caught by the similarity check below
+        keys = signatures[candidates, band * rows:(band + 1) * rows].dot(mix)
+        _, bucket = np.unique(keys, return_inverse=True)
+        # compare each song to the first song of its bucket only, so that a big bucket stays linear
+        first = np.full(bucket.max() + 1 if len(bucket) else 0, len(candidates), dtype=int)
+        np.minimum.at(first, bucket, position)
+        first = first[bucket]
+        others = position[first != position]
+        similarity = (signatures[candidates[others]] == signatures[candidates[first[others]]]).mean(axis=1)
+        similar = others[similarity >= threshold]
+        for i, j in zip(candidates[similar], candidates[first[similar]]):
+            parent[_find(parent, i)] = _find(parent, j)
+
+    roots = np.array([_find(parent, i) for i in range(nb_song)], dtype=int)
+    clusters = {}
+    for i in np.nonzero(roots != np.arange(nb_song))[0]:
+        clusters.setdefault(roots[i], [int(roots[i])]).append(int(i))
+    return sorted(sorted(cluster) for cluster in clusters.values())
+
+
+def deduplicate(M, C, sw=None, num_perm=128, bands=16, threshold=0.7, chunk=10000):
+    """
+    :param M, C: dense (nb_song, T, 12) or packed (nb_song, T), see packed.py. They can be memory-mapped
+    :param chunk: number of songs shingled at once
+    :return: (keep, clusters). keep is the sorted indexes of the songs to keep, one per cluster (its first song)
+             and all the songs without near-duplicate. clusters is the output of lsh_clusters
+    """
+    packed = np.ndim(C) == 2
+
+    def dense(i):
+        if packed:
+            return unpack_melody(M[i:i + chunk]), unpack_chroma(C[i:i + chunk])
+        return M[i:i + chunk], C[i:i + chunk]
+    signatures = np.concatenate([minhash(*shingles(*dense(i), sw=None if sw is None else sw[i:i + chunk]),
+                                         num_perm=num_perm)
+                                 for i in range(0, len(M), chunk)] or [np.zeros((0, num_perm), dtype=np.int64)])
+    clusters = lsh_clusters(signatures, bands, threshold)
+    drop = np.zeros(len(M), dtype=bool)
+    for cluster in clusters:
+        drop[cluster[1:]] = True
+    return np.nonzero(~drop)[0], clusters
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report near-duplicate songs of a dense or bit-packed dataset')
+    parser.add_argument('melody', help='melody .npy')
+    parser.add_argument('chord', help='chord .npy')
+    parser.add_argument('--sw', help='sample weight .npy')
+    parser.add_argument('--threshold', type=float, default=0.7, help='Min Jaccard similarity. Default = 0.7')
+    parser.add_argument('--report', help='Write the clusters to this JSON file')
+    args = parser.parse_args()
+    M, C = np.load(args.melody, mmap_mode='r'), np.load(args.chord, mmap_mode='r')
+    sw = np.load(args.sw, mmap_mode='r') if args.sw else None
+    keep, clusters = deduplicate(M, C, sw, threshold=args.threshold)
+    print "%d near-duplicate clusters, keeping %d songs out of %d" % (len(clusters), len(keep), len(M))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'clusters': clusters, 'keep': keep.tolist()}, f)
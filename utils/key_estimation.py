@@ -0,0 +1,97 @@
+"""
+Estimate the key of songs from their notes, and transpose them to C major
+
+The TheoryTab songs of gen_csv.py come with their key, the MIDI corpus of parse_big_data doesn't.
+The key is the major or minor Krumhansl-Kessler profile that correlates best with the pitch class histogram of the
+melody and chords. Like gen_csv.py, minor keys are taken as their relative major, so every song ends up in C major
+(or A minor) and the 12 transpositions of util.dataAug aren't needed to cover all keys.
+"""
+import numpy as np
+
+# Krumhansl-Kessler key profiles, from C
+MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+MINOR_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+
+def _templates():
+    """
+    :return: (24, 12) profiles of the 12 major then the 12 minor keys, centered and normalized
+    """
+    index = (np.arange(12)[None, :] - np.arange(12)[:, None]) % 12  # row k is the profile rotated to tonic k
+    templates = np.concatenate((MAJOR_PROFILE[index], MINOR_PROFILE[index]), axis=0)
+    templates -= templates.mean(axis=1, keepdims=True)
+    return templates / np.linalg.norm(templates, axis=1, keepdims=True)
+
+TEMPLATES = _templates()
+
+
+def estimate_key(M, C, sw=None):
+    """
+    Estimate the key of a batch of songs
+
+    :param M: melody (nb_song, T, 12)
+    :param C: chord (nb_song, T, 12)
+    :param sw: optional sample weight (nb_song, T), frames of weight 0 are ignored
+    :return: (key, mode) arrays of shape (nb_song,), key in [0, 11] and mode 0 for major, 1 for minor
+    """
+    notes = M + C
+    if sw is not None:
+        notes = notes * (sw[:, :, None] > 0)
+    return estimate_key_histogram(notes.sum(axis=1))
+
+
+def estimate_key_histogram(histogram):
+    """
+    :param histogram: (nb_song, 12) number of frames each pitch class is played
+    :return: (key, mode), like estimate_key
+    """
+    histogram = histogram.astype(float)
+    histogram -= histogram.mean(axis=1, keepdims=True)
+    norm = np.linalg.norm(histogram, axis=1, keepdims=True)
+    histogram /= np.where(norm > 0, norm, 1)
+    # songs without any note correlate 0 with everything and get C major
+    best = histogram.dot(TEMPLATES.T).argmax(axis=1)
+    return best % 12, best // 12
+
+
+def major_key(key, mode):
+    """
+    Vectorized util.toMajKey for major and minor keys
+
+    :return: the key of the relative major
+    """
+    return np.where(mode == 1, (key + 3) % 12, key)
+
+
+def transpose(X, semitones):
+    """
+    Transpose every song down by its own number of semitones, e.g. by its major key to bring it to C
+
+    :param X: (nb_song, T, 12)
+    :param semitones: (nb_song,)
+    :return: (nb_song, T, 12)
+    """
+    index = (np.arange(12)[None, :] + np.asarray(semitones)[:, None]) % 12
+    return X[np.arange(len(X))[:, None, None], np.arange(X.shape[1])[None, :, None], index[:, None, :]]
+
+
+def transpose_frames(X, semitones):
+    """
+    transpose for songs packed frame after frame
+
+    :param X: (nb_frame, 12)
+    :param semitones: (nb_frame,), the semitones of the song of each frame
+    :return: (nb_frame, 12)
+    """
+    index = (np.arange(12)[None, :] + np.asarray(semitones)[:, None]) % 12
+    return X[np.arange(len(X))[:, None], index]
+
+
+def normalize_key(M, C, sw=None):
+    """
+    Transpose songs to C major (or A minor) after estimating their key
+
+    :return: (M, C, key) with key the major key each song was transposed from
+    """
+    key = major_key(*estimate_key(M, C, sw))
+    return transpose(M, key), transpose(C, key), key
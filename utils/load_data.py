@@ -1,20 +1,47 @@
 from build_chord_repr import ChordNotes2OneHotTranscoder
+from dedup import deduplicate
+from key_estimation import transpose
+import npy_cache
+from shards import build_shards, load_shards
+from packed import Data, PackedData, pack_chroma, pack_melody, unpack_chroma, unpack_melody
 from collections import namedtuple
+from multiprocessing import cpu_count
 import numpy as np
-import csv
+import json
 import os
-from util import dataAug, rotateNotes
 
-Data = namedtuple('Data', ['melody', 'chord', 'sw'])
 
+VALIDATION_CHECKS = ('empty_chord', 'all_zero', 'unseen_chord')
+# transposition augmentation: number of samples each song makes
+AUGMENTATIONS = {'none': 1, 'random': 1, 'all': 12}
+# input value of the padding frames, skipped by the Masking layer of model.build. 0 is a rest
+MASK_VALUE = -1.
 
-def load_data(alg, nb_test):
-    chord, melody, sw = parse_data(alg, 128)
-    # checkAllZero = np.sum(chord, axis=(1,2))!=0
+
+def select_songs(alg, melody, chord, sw, flagged=None):
+    """
+    :param melody, chord, sw: bit-packed dataset, see parse_data_compact
+    :param flagged: optional (N,) bool, songs to drop, see flagged_songs
+    :return: indexes of the songs load_data keeps
+    """
     checkAllZero = np.arange(474)
-    chord = chord[checkAllZero]
-    melody = melody[checkAllZero]
-    sw = sw[checkAllZero]
+    if flagged is not None:
+        checkAllZero = checkAllZero[~flagged[checkAllZero]]
+    if 'dedup' in alg and alg.dedup:
+        # keep one song per cluster of near-duplicates, so that none leaks between train and test
+        keep, clusters = deduplicate(melody[checkAllZero], chord[checkAllZero], sw[checkAllZero])
+        print "Dropping %d near-duplicate songs in %d clusters" % (len(checkAllZero) - len(keep), len(clusters))
+        checkAllZero = checkAllZero[keep]
+    return checkAllZero
+
+
+def load_data(alg, nb_test):
+    chord, melody, sw = parse_data_compact(alg, 128)
+    selected = select_songs(alg, melody, chord, sw, flagged_songs(alg, chord, sw))
+    # only the selected songs are unpacked
+    chord = unpack_chroma(chord[selected])
+    melody = unpack_melody(melody[selected])
+    sw = sw[selected]
 
     # Up sample
     melodyTrain, chordTrain, swTrain = melody[:-nb_test], chord[:-nb_test], sw[:-nb_test]
@@ -26,8 +53,67 @@ def load_data(alg, nb_test):
     # nb_test *= 3
     return {'train': Data(melody=melodyTrain, chord=chordTrain, sw=swTrain),
             'test':  Data(melody=melodyTest,  chord=chordTest,  sw=swTest)}
-    #return {'train': Data(melody=dataAug(melody[:-nb_test]), chord=dataAug(chord[:-nb_test]), sw=np.tile(sw[:-nb_test], (12,1))),
-    #        'test': Data(melody=dataAug(melody[-nb_test:]), chord=dataAug(chord[-nb_test:]), sw=np.tile(sw[-nb_test:], (12,1)))}
+
+
+def mask_padding(x, sw):
+    """
+    Set the frames of sample weight 0, the padding, of a model input to MASK_VALUE, in place
+
+    :param x: (n, T, dim) model input
+    :param sw: (n, T) sample weight
+    :return: x
+    """
+    x[np.asarray(sw) == 0] = MASK_VALUE
+    return x
+
+
+def augment(batch, mode):
+    """
+    Transpose the songs of a batch, melody and chord together, instead of storing the 12 transpositions of util.dataAug
+
+    :param batch: Data of (n, T, 12) melody and chord
+    :param mode: see AUGMENTATIONS. 'random' transposes each song by a random number of semitones,
+                 'all' makes the 12 transpositions of each song, ordered like util.dataAug
+    :return: Data
+    """
+    n = len(batch.melody)
+    if mode == 'random':
+        shift = np.random.randint(12, size=n)
+        return Data(melody=transpose(batch.melody, shift), chord=transpose(batch.chord, shift), sw=batch.sw)
+    if mode == 'all':
+        # transpose() shifts down, dataAug rotates up
+        shift = -np.repeat(np.arange(12), n) % 12
+        return Data(melody=transpose(np.tile(batch.melody, (12, 1, 1)), shift),
+                    chord=transpose(np.tile(batch.chord, (12, 1, 1)), shift), sw=np.tile(batch.sw, (12, 1)))
+    return batch
+
+
+def load_packed_data(alg, nb_test):
+    """
+    load_data, but the songs stay bit-packed in memory until padded() expands the songs of a batch.
+    Each song keeps its own length: the frames after its last weighted frame with a chord or a melody note are
+    dropped, so that bucketed batches are only padded to their longest song
+
+    With alg.dataset == 'big', the songs are the shards of parse_big_data_packed, cut to alg.max_length.
+    They are not deduplicated nor validated
+
+    :return: {'train': PackedData, 'test': PackedData}
+    """
+    if 'dataset' in alg and alg.dataset == 'big':
+        data = parse_big_data_packed(alg.max_length)
+        return {'train': data.subset(slice(None, len(data) - nb_test)),
+                'test': data.subset(slice(len(data) - nb_test, None))}
+    chord, melody, sw = parse_data_compact(alg, 128)
+    selected = select_songs(alg, melody, chord, sw, flagged_songs(alg, chord, sw))
+    chord, melody, sw = chord[selected], melody[selected], sw[selected]
+    length = chord.shape[1]
+    played = (sw > 0) & ((chord != 0) | (melody >= 0))
+    # at least one frame, so that a batch of empty songs still has a time step
+    lengths = np.where(played.any(axis=1), length - np.argmax(played[:, ::-1], axis=1), 1)
+    keep = np.arange(length)[None, :] < lengths[:, None]
+    sw = sw[keep]
+    data = PackedData(melody[keep], chord[keep], np.append(0, np.cumsum(lengths)), None if np.all(sw == 1) else sw)
+    return {'train': data.subset(slice(None, -nb_test)), 'test': data.subset(slice(-nb_test, None))}
 
 
 class InputParser(object):
@@ -63,23 +149,29 @@ class PairedInputParser(InputParser):
     def __init__(self, alg):
         self.alg = alg
         self.transcoder = ChordNotes2OneHotTranscoder()
+        self.negatives = alg.negatives if 'negatives' in alg and alg.negatives else 1
 
-    def get_XY(self, M, C):
-        n = M.shape[0]
-        idx = np.random.randint(n, size=n)
-        C_neg = C[idx]
-        Ones = np.ones((n, 128, 1))
-        Zeros = np.zeros((n, 128, 1))
-        add    = C - C_neg == 1
-        delete = C_neg - C == 1
-
-        MC_pos = np.concatenate((M, C), 2)
-        MC_neg = np.concatenate((M, C_neg), 2)
-        X = np.concatenate((MC_pos, MC_neg), 0)
-
-        YAdd    = np.concatenate((np.tile(Zeros, 12), add), 0)
-        YDelete = np.concatenate((np.tile(Zeros, 12), delete), 0)
-        Y = np.concatenate((YAdd, YDelete), 2)
+    def get_XY(self, M, C, C_neg=None):
+        """
+        Pair each melody with its chords, then with self.negatives other chords
+
+        :param C_neg: (n * negatives, T, 12) negative chords, the k-th negatives of all songs after the (k-1)-th.
+                      Drawn from C by default
+        :return: X (n * (1 + negatives), T, 24), Y the notes to add then to delete to get the true chords
+        """
+        n, length = M.shape[:2]
+        if C_neg is None:
+            C_neg = C[np.random.randint(n, size=n * self.negatives)]
+        C_rep = np.tile(C, (self.negatives, 1, 1))
+        M_rep = np.tile(M, (self.negatives, 1, 1))
+        X = np.empty((n + len(C_neg), length, 24), dtype=np.float32)
+        X[:n, :, :12], X[:n, :, 12:] = M, C
+        X[n:, :, :12], X[n:, :, 12:] = M_rep, C_neg
+
+        # positive pairs need no change
+        Y = np.zeros((n + len(C_neg), length, 24), dtype=np.float32)
+        Y[n:, :, :12] = C_rep - C_neg == 1
+        Y[n:, :, 12:] = C_neg - C_rep == 1
         return X, Y
 
 def get_test(args, m, M, C):
@@ -131,80 +223,139 @@ def select_closest_n(m, M):
 
 
 def parse_data(alg, max_length):
-    with open('csv/npy-exists.config') as keyvaluefile:
-        avaialable = [key[0] for key in csv.reader(keyvaluefile)]
-        if 'sample-biased' not in alg.model and 'normal' in avaialable:
-            print "I can load normal set of params from npy files"
-            M = np.load('csv/normal-melody.npy')
-            C = np.load('csv/normal-chord.npy')
-            SW = np.load('csv/normal-sampleweight.npy')
-            return C, M, SW
-
-        if 'sample-biased' in alg.model and 'sample-biased' in avaialable:
-            print "I can load sample-biased set of params from npy files"
-            M = np.load('csv/sample-biased-melody.npy')
-            C = np.load('csv/sample-biased-chord.npy')
-            SW = np.load('csv/sample-biased-sampleweight.npy')
-            return C, M, SW
+    """
+    :return: C, M, sample_weight as dense float32 arrays of shape (N, 128, 12), (N, 128, 12) and (N, 128)
+    """
+    C, M, SW = parse_data_compact(alg, max_length)
+    return unpack_chroma(C), unpack_melody(M), SW
+
+
+def dataset_variant(alg):
+    return 'sample-biased' if 'sample-biased' in alg.model else 'normal'
+
+
+def parse_data_compact(alg, max_length):
+    """
+    Same as parse_data, but with the frames bit-packed as in packed.py.
+    The arrays are cached in csv/cache/ and loaded memory-mapped, see npy_cache.py
+
+    :return: C (N, 128) uint16 chord bitmasks, M (N, 128) int8 melody pitch classes (-1 for rests),
+             sample_weight (N, 128) float32
+    """
+    key = dataset_variant(alg)
+    prefix = npy_cache.prefix(key)
+    cached = npy_cache.load(prefix, ('chord', 'melody', 'sampleweight'))
+    if cached is not None:
+        print "I can load %s set of params from npy files" % key
+        return cached['chord'], cached['melody'], cached['sampleweight']
 
     C = np.genfromtxt('csv/chord.csv', delimiter=',')
-    # Data in melody.csv and root.csv are represented as [0,11].
-    # Thus, we first span it to boolean matrix
+    # Data in melody.csv and root.csv are represented as [0,11], rests are empty
     M_dense = np.genfromtxt('csv/melody.csv', delimiter=',')
     assert (M_dense.shape[1] * 12 == C.shape[1])
-    M = np.zeros((M_dense.shape[0], M_dense.shape[1] * 12))
-    sample_weight = np.zeros(M_dense.shape)  # Use this if using variable length
-    for i in range(M_dense.shape[0]):
-        for j in range(M_dense.shape[1]):
-            if not np.isnan(M_dense[i][j]):
-                notes = int(M_dense[i][j])
-                M[i][M_dense.shape[1] * notes + j] = 1
-                sample_weight[i][j] = 1
+    M = np.where(np.isnan(M_dense), -1, M_dense).astype(np.int8)
     C = np.nan_to_num(C)
-    M = np.swapaxes(M.reshape((M_dense.shape[0], 12, M_dense.shape[1])), 1, 2)
-    C = np.swapaxes(C.reshape((C.shape[0], 12, -1)), 1, 2)
+    C = pack_chroma(np.swapaxes(C.reshape((C.shape[0], 12, -1)), 1, 2))
 
-    sample_weight = np.ones((C.shape[0], C.shape[1]))
+    sample_weight = np.ones(C.shape, dtype=np.float32)
     if 'sample-biased' in alg.model:
         for p in range(1, 8):
             sample_weight[:, ::2 ** p] += 1
         sample_weight /= 8.0
 
     # store
-    with open('csv/npy-exists.config', 'w') as keyvaluefile:
-        avaialable = csv.writer(keyvaluefile)
-        key = 'sample-biased' if 'sample-biased' in alg.model else 'normal'
-        avaialable.writerow([key])
-        np.save('csv/' + key + '-chord', C)
-        np.save('csv/' + key + '-melody', M)
-        np.save('csv/' + key + '-sampleweight', sample_weight)
+    npy_cache.save(prefix, {'chord': C, 'melody': M, 'sampleweight': sample_weight})
+    validation_report(alg, C, sample_weight)
     return C, M, sample_weight
 
 
-def parse_big_data(alg, max_length):
-    nb_train = sum([len(files) for r, d, files in os.walk("../dataset/melody")])
-    C = np.zeros((nb_train, max_length, 12))
-    M = np.zeros((nb_train, max_length, 12))
-    sample_weight = np.zeros((nb_train, max_length))
-    train_idx = 0
-    for root, _, files in os.walk("../dataset/melody"):
-        for m_file_name in files:
-            m_file_name_path = os.path.join(root, m_file_name)
-            c_file_name_path = m_file_name_path.replace("/melody/", "/chord/", 1)
-            m_file_matrix = np.genfromtxt(m_file_name_path, delimiter=',')
-            c_file_matrix = np.genfromtxt(c_file_name_path, delimiter=',')
-            if len(m_file_matrix) == 0 or len(c_file_matrix) == 0: continue
-            m_file_matrix = m_file_matrix[:, :max_length]
-            c_file_matrix = c_file_matrix[:, :max_length]
-            seq_len = min(m_file_matrix.shape[1], c_file_matrix.shape[1])
-            tmp_m, tmp_c = np.zeros((12, seq_len)), np.zeros((12, seq_len))
-            for i in range(128 / 12):
-                tmp_m = np.logical_or(tmp_m, m_file_matrix[i * 12:(i + 1) * 12, :seq_len])
-                tmp_c = np.logical_or(tmp_c, c_file_matrix[i * 12:(i + 1) * 12, :seq_len])
-            sample_weight[train_idx, :seq_len] = np.ones((1, seq_len))
-            M[train_idx, :seq_len], C[train_idx, :seq_len] = np.swapaxes(tmp_m, 0, 1), np.swapaxes(tmp_c, 0, 1)
-            train_idx += 1
-    C = C[:train_idx]
-    M = M[:train_idx]
-    sample_weight = sample_weight[:train_idx]
-    return C, M, sample_weight
+def known_chords():
+    """
+    :return: (4096,) bool, whether each chord bitmask has a signature in ChordNotes2OneHotTranscoder
+    """
+    known = np.zeros(1 << 12, dtype=bool)
+    known[pack_chroma(np.load('csv/chord-1hot-signatures-rev.npy'))] = True
+    return known
+
+
+def validate_data(C, sw=None, known=None):
+    """
+    Check every frame of the dataset at once
+
+    :param C: (N, T) chord bitmasks, see parse_data_compact
+    :param sw: optional (N, T) sample weight, frames of weight 0 are not checked
+    :param known: optional (4096,) bool, see known_chords. unseen_chord is only checked when given
+    :return: report of the number of frames failing each check and the songs with such frames:
+             {'songs': N, 'frames': F, 'checks': {check: {'frames': n, 'songs': [indexes]}}}
+    """
+    played = np.ones(C.shape, dtype=bool) if sw is None else np.asarray(sw) > 0
+    C = np.asarray(C).astype(np.int64)
+    empty = C == 0
+    # no check of the roots: csv/root.csv holds the root chroma2chord derives from the chord, 0 when the chord isn't
+    # recognized, and gen_csv.py already adds the MIDI root note to the chord of the frames with a single one
+    failed = {'empty_chord': empty & played,
+              # a song is all zero when none of its frames has a chord, so each of its frames counts
+              'all_zero': played & ~(~empty & played).any(axis=1)[:, None]}
+    if known is not None:
+        failed['unseen_chord'] = ~known[C] & played
+    checks = {name: {'frames': int(frames.sum()), 'songs': np.nonzero(frames.any(axis=1))[0].tolist()}
+              for name, frames in failed.items()}
+    return {'songs': len(C), 'frames': int(played.sum()), 'checks': checks}
+
+
+def validation_report(alg, C, sw):
+    """
+    Validation report of the dataset of parse_data_compact, cached next to it
+
+    :return: see validate_data
+    """
+    path = npy_cache.prefix(dataset_variant(alg)) + '-validation.json'
+    if os.path.exists(path):
+        with open(path) as f:
+            report = json.load(f)
+        # reports written with other checks are built again
+        if sorted(report['checks']) == sorted(VALIDATION_CHECKS):
+            return report
+    report = validate_data(C, sw, known_chords())
+    with open(path + '.tmp', 'w') as f:
+        json.dump(report, f)
+    os.rename(path + '.tmp', path)
+    return report
+
+
+def flagged_songs(alg, C, sw):
+    """
+    :return: (N,) bool, songs failing one of the checks of alg.drop_flagged, or None when there is none
+    """
+    if 'drop_flagged' not in alg or not alg.drop_flagged:
+        return None
+    report = validation_report(alg, C, sw)
+    flagged = np.zeros(report['songs'], dtype=bool)
+    for check in alg.drop_flagged:
+        flagged[report['checks'][check]['songs']] = True
+    print "Dropping %d songs flagged by %s" % (flagged.sum(), ', '.join(alg.drop_flagged))
+    return flagged
+
+
+def parse_big_data(alg, max_length, transpose_to_c=True, workers=cpu_count()):
+    """
+    Read the melody and chord tracks of the MIDI corpus, padded to max_length
+
+    :param transpose_to_c: transpose each song to C major from its estimated key, so that training doesn't need dataAug
+    :return: C, M, sample_weight
+    """
+    data = parse_big_data_packed(max_length, transpose_to_c, workers).padded(length=max_length)
+    return data.chord, data.melody, data.sw
+
+
+def parse_big_data_packed(max_length, transpose_to_c=True, workers=cpu_count()):
+    """
+    Read the melody and chord tracks of the MIDI corpus, through memory-mapped shards built on first use
+
+    :return: PackedData of the songs, cut to max_length
+    """
+    directory = '../dataset/shards-%d%s' % (max_length, '-C' if transpose_to_c else '')
+    if not os.path.exists(os.path.join(directory, 'index.json')):
+        build_shards('../dataset/melody', directory, max_length, workers=workers, transpose_to_c=transpose_to_c)
+    _, data, _ = load_shards(directory)
+    return data
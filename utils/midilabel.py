@@ -0,0 +1,44 @@
+"""
+Read the melody, chord and bass tracks written by preprocess/ into midilabel/
+
+A track is either a dense 128xT integer CSV, or a .npz holding its runs of constant velocity, CSR-style:
+- shape: (128, T), shape of the dense piano roll
+- pitch, onset, offset, velocity: one entry per run. The pitch is played at velocity in frames [onset, offset)
+Tracks are almost all zeros, so the .npz is a lot smaller and faster to load than the CSV
+"""
+import numpy as np
+
+
+def read_track(path):
+    """
+    :return: the dense (128, T) piano roll of a .npz track
+    """
+    track = np.load(path)
+    pitch, velocity = track['pitch'].astype(int), track['velocity'].astype(int)
+    n_pitch, length = track['shape']
+    roll = np.zeros((n_pitch, length + 1), dtype=int)
+    np.add.at(roll, (pitch, track['onset']), velocity)
+    np.add.at(roll, (pitch, track['offset']), -velocity)
+    return np.cumsum(roll, axis=1)[:, :length]
+
+
+def read_chroma(path):
+    """
+    :return: the (12, T) chroma of a .npz track, a pitch class is on when any of its octaves is played
+    """
+    track = np.load(path)
+    length = track['shape'][1]
+    count = np.zeros((12, length + 1), dtype=int)
+    pitch_class = track['pitch'].astype(int) % 12
+    np.add.at(count, (pitch_class, track['onset']), 1)
+    np.add.at(count, (pitch_class, track['offset']), -1)
+    return np.cumsum(count, axis=1)[:, :length] > 0
+
+
+def load_track(path):
+    """
+    :return: the dense piano roll of a track, either CSV or .npz
+    """
+    if path.endswith('.npz'):
+        return read_track(path)
+    return np.genfromtxt(path, delimiter=',')
@@ -0,0 +1,86 @@
+"""
+Cache of the arrays parsed from the csv/ files, keyed by the content of the files and the dataset variant
+
+Arrays are stored in csv/cache/ as <variant>-<digest>-<name>.npy, digest being a hash of the variant and of the
+source CSVs. Variants are cached side by side, and a cache built from other CSVs doesn't match their current digest:
+it is stale, and removed when the variant is built again. Cached arrays are loaded memory-mapped.
+"""
+import os
+import hashlib
+import numpy as np
+
+SOURCES = ('csv/chord.csv', 'csv/melody.csv', 'csv/root.csv')
+CACHE_DIR = 'csv/cache'
+
+
+def digest(variant, sources=SOURCES):
+    """
+    :return: hex digest of the variant name and the content of the source files
+    """
+    sha = hashlib.sha1(variant)
+    for source in sources:
+        with open(source, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()[:16]
+
+
+def prefix(variant, sources=SOURCES, directory=CACHE_DIR):
+    """
+    :return: path prefix of the cached arrays of the variant built from the current sources
+    """
+    return os.path.join(directory, '%s-%s' % (variant, digest(variant, sources)))
+
+
+def entries(directory=CACHE_DIR):
+    """
+    :return: list of (variant, digest, file name) of the cached files
+    """
+    if not os.path.isdir(directory):
+        return []
+    found = []
+    for name in sorted(os.listdir(directory)):
+        parts = name.rsplit('-', 2)
+        if len(parts) == 3 and not name.endswith('.tmp'):
+            found.append((parts[0], parts[1], name))
+    return found
+
+
+def stale(sources=SOURCES, directory=CACHE_DIR):
+    """
+    :return: names of the cached files whose digest doesn't match the current sources
+    """
+    current = {}
+    for variant, key, name in entries(directory):
+        if variant not in current:
+            current[variant] = digest(variant, sources)
+    return [name for variant, key, name in entries(directory) if key != current[variant]]
+
+
+def load(path_prefix, names):
+    """
+    :return: dict of the memory-mapped arrays, or None if one of them isn't cached
+    """
+    paths = {name: '%s-%s.npy' % (path_prefix, name) for name in names}
+    if not all(os.path.exists(path) for path in paths.values()):
+        return None
+    return {name: np.load(path, mmap_mode='r') for name, path in paths.items()}
+
+
+def save(path_prefix, arrays):
+    """
+    Write the arrays of a variant, each through a temporary file so that no reader sees a partial array,
+    then remove the stale files of the variant
+    """
+    directory, base = os.path.split(path_prefix)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for name, array in arrays.items():
+        path = '%s-%s.npy' % (path_prefix, name)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, array)
+        os.rename(path + '.tmp', path)
+    variant, key = base.rsplit('-', 1)
+    for other, other_key, name in entries(directory):
+        if other == variant and other_key != key:
+            os.remove(os.path.join(directory, name))
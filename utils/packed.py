@@ -0,0 +1,245 @@
+"""
+Songs of different lengths stored without padding, one compact code per frame
+
+A PackedData holds the frames of all songs one after the other, and the offsets of each song in them:
+the melody and chord of song i are melody[offsets[i]:offsets[i+1]] and chord[offsets[i]:offsets[i+1]].
+Frames are bit-packed:
+- chord: uint16 bitmask of the 12 pitch classes, bit p for pitch class p
+- melody: int8 pitch class, -1 for a rest, when the melody plays at most one pitch class at a time.
+  Otherwise a uint16 bitmask like the chords
+Padded Data, the dense (nb_song, length, 12) arrays and sample weight the models take, are only built for the songs
+of a batch, either to a fixed length or to the longest song of the batch.
+The frames can also be a FrameParts, the frames of several arrays (e.g. memory-mapped shards) read as one.
+"""
+from collections import namedtuple
+import numpy as np
+
+Data = namedtuple('Data', ['melody', 'chord', 'sw'])
+
+_bits = 1 << np.arange(12)
+
+
+def pack_chroma(X):
+    """
+    :param X: (..., 12)
+    :return: (...) uint16 bitmask
+    """
+    return (np.asarray(X) != 0).dot(_bits).astype(np.uint16)
+
+
+def unpack_chroma(bits, dtype=np.float32):
+    """
+    :return: (..., 12) of 0 and 1
+    """
+    return ((np.asarray(bits)[..., None] >> np.arange(12)) & 1).astype(dtype)
+
+
+def pack_melody(X):
+    """
+    :param X: (..., 12)
+    :return: (...) int8 pitch class if there is never more than one, uint16 bitmask otherwise
+    """
+    notes = np.asarray(X) != 0
+    count = notes.sum(axis=-1)
+    if np.all(count <= 1):
+        return np.where(count > 0, notes.argmax(axis=-1), -1).astype(np.int8)
+    return pack_chroma(notes)
+
+
+def unpack_melody(codes, dtype=np.float32):
+    """
+    :return: (..., 12) of 0 and 1
+    """
+    codes = np.asarray(codes)
+    if codes.dtype != np.int8:
+        return unpack_chroma(codes, dtype)
+    X = np.zeros(codes.shape + (12,), dtype=dtype)
+    played = codes >= 0
+    X[played, codes[played]] = 1
+    return X
+
+
+def _melody_as_bits(codes):
+    codes = np.asarray(codes)
+    if codes.dtype != np.int8:
+        return codes
+    return np.where(codes >= 0, np.left_shift(1, codes.astype(int)), 0).astype(np.uint16)
+
+
+class FrameParts(object):
+    """
+    Frames of several arrays read as one without copying them, for the memory-mapped shards of shards.py.
+    Indexing with an integer array or a slice returns an ndarray, except a slice of step 1 which stays a FrameParts
+    of views of the parts. Melody parts of both codes are read as uint16 bitmasks
+
+    :param parts: list of (nb_frame,) arrays
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.starts = np.append(0, np.cumsum([len(part) for part in parts])).astype(np.int64)
+        dtypes = set(part.dtype for part in parts)
+        self.convert = len(dtypes) > 1
+        self.dtype = np.dtype(np.uint16) if self.convert else (dtypes.pop() if dtypes else np.dtype(np.uint16))
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    @property
+    def nbytes(self):
+        return sum(part.nbytes for part in self.parts)
+
+    def _part(self, p, index):
+        frames = self.parts[p][index]
+        return _melody_as_bits(frames) if self.convert else frames
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                stop = max(start, stop)
+                first = np.searchsorted(self.starts, start, side='right') - 1
+                last = np.searchsorted(self.starts, stop, side='left')
+                return FrameParts([self.parts[p][max(start - self.starts[p], 0):stop - self.starts[p]]
+                                   for p in range(first, last)])
+            index = np.arange(start, stop, step)
+        index = np.asarray(index, dtype=np.int64)
+        part = np.searchsorted(self.starts, index, side='right') - 1
+        frames = np.empty(index.shape, dtype=self.dtype)
+        for p in np.unique(part):
+            selected = part == p
+            frames[selected] = self._part(p, index[selected] - self.starts[p])
+        return frames
+
+    def __array__(self, dtype=None):
+        frames = self[np.arange(len(self))]
+        return frames if dtype is None else frames.astype(dtype)
+
+
+class PackedData(object):
+    """
+    :param melody: (nb_frame,) melody codes of all songs, see pack_melody. An array or a FrameParts
+    :param chord: (nb_frame,) chord bitmasks, see pack_chroma. An array or a FrameParts
+    :param offsets: (nb_song + 1,) start of each song in the frames, then nb_frame
+    :param sw: optional (nb_frame,) sample weight of each frame, 1 by default
+    """
+
+    def __init__(self, melody, chord, offsets, sw=None):
+        assert len(melody) == len(chord) == offsets[-1]
+        self.melody = melody
+        self.chord = chord
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.sw = sw
+
+    @staticmethod
+    def from_padded(M, C, sw):
+        """
+        Pack (nb_song, T, 12) arrays, keeping the frames of each song up to its last frame of non-zero weight
+        """
+        sw = np.asarray(sw)
+        valid = sw > 0
+        lengths = np.where(valid.any(axis=1), valid.shape[1] - np.argmax(valid[:, ::-1], axis=1), 0)
+        keep = np.arange(valid.shape[1])[None, :] < lengths[:, None]
+        weights = sw[keep].astype(np.float32)
+        return PackedData(pack_melody(M[keep]), pack_chroma(C[keep]), np.append(0, np.cumsum(lengths)),
+                          None if np.all(weights == 1) else weights)
+
+    @staticmethod
+    def concatenate(packs, copy=True):
+        """
+        :param copy: join the frames into new arrays, or read them in place through FrameParts
+        """
+        offsets = [np.zeros(1, dtype=np.int64)]
+        for pack in packs:
+            offsets.append(pack.offsets[1:] + offsets[-1][-1])
+        if not copy and all(pack.sw is None for pack in packs):
+            return PackedData(FrameParts([pack.melody for pack in packs]), FrameParts([pack.chord for pack in packs]),
+                              np.concatenate(offsets))
+        melodies = [pack.melody for pack in packs]
+        if len(set(melody.dtype for melody in melodies)) > 1:
+            melodies = [_melody_as_bits(melody) for melody in melodies]
+        sw = None
+        if any(pack.sw is not None for pack in packs):
+            sw = np.concatenate([np.ones(len(pack.melody), dtype=np.float32) if pack.sw is None else pack.sw
+                                 for pack in packs])
+        return PackedData(np.concatenate(melodies), np.concatenate([pack.chord for pack in packs]),
+                          np.concatenate(offsets), sw)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.melody, self.chord, self.offsets, self.sw) if a is not None)
+
+    def song(self, i, dtype=np.float32):
+        """
+        :return: (melody, chord) of song i, of shape (length, 12)
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return unpack_melody(self.melody[start:end], dtype), unpack_chroma(self.chord[start:end], dtype)
+
+    def subset(self, indexes):
+        """
+        :return: PackedData of the songs at indexes, in that order. A slice of consecutive songs shares the
+                 frames of this PackedData instead of copying them
+        """
+        if isinstance(indexes, slice) and indexes.step in (None, 1):
+            start, stop, _ = indexes.indices(len(self))
+            stop = max(start, stop)
+            first, last = self.offsets[start], self.offsets[stop]
+            return PackedData(self.melody[first:last], self.chord[first:last], self.offsets[start:stop + 1] - first,
+                              None if self.sw is None else self.sw[first:last])
+        indexes = np.arange(len(self))[indexes]
+        lengths = self.lengths[indexes]
+        frames = self._frames(indexes, lengths)
+        return PackedData(self.melody[frames], self.chord[frames], np.append(0, np.cumsum(lengths)),
+                          None if self.sw is None else self.sw[frames])
+
+    def _frames(self, indexes, lengths):
+        starts = np.repeat(self.offsets[indexes] - np.append(0, np.cumsum(lengths)[:-1]), lengths)
+        return starts + np.arange(lengths.sum())
+
+    def padded(self, indexes=None, length=None, dtype=np.float32):
+        """
+        Dense Data of some songs, cut or padded with zeros to length
+
+        :param indexes: songs of the batch, all of them by default
+        :param length: length of the batch, the longest song of the batch by default
+        :return: Data of (n, length, 12) melody and chord, and (n, length) sample weight
+        """
+        indexes = np.arange(len(self)) if indexes is None else np.arange(len(self))[indexes]
+        lengths = self.lengths[indexes]
+        if length is None:
+            length = lengths.max() if len(lengths) else 0
+        lengths = np.minimum(lengths, length)
+        played = np.arange(length)[None, :] < lengths[:, None]
+        frames = self._frames(indexes, lengths)
+        M = np.zeros((len(indexes), length, 12), dtype=dtype)
+        C = np.zeros((len(indexes), length, 12), dtype=dtype)
+        sw = played.astype(dtype)
+        M[played] = unpack_melody(self.melody[frames], dtype)
+        C[played] = unpack_chroma(self.chord[frames], dtype)
+        if self.sw is not None:
+            sw[played] = self.sw[frames]
+        return Data(melody=M, chord=C, sw=sw)
+
+    def batches(self, batch_size, length=None, bucket=False, shuffle=True):
+        """
+        Generate padded Data batches over all the songs once
+
+        :param length: pad or cut every batch to length, or to the longest song of each batch by default
+        :param bucket: batch songs of similar lengths together, so that short songs aren't padded to long ones
+        """
+        order = np.random.permutation(len(self)) if shuffle else np.arange(len(self))
+        if bucket:
+            order = order[np.argsort(self.lengths[order], kind='mergesort')]
+        starts = np.arange(0, len(self), batch_size)
+        if shuffle:
+            np.random.shuffle(starts)
+        for start in starts:
+            yield self.padded(order[start:start + batch_size], length)
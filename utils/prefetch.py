@@ -0,0 +1,145 @@
+"""
+Prepare training batches in background threads while the model trains on the previous ones
+
+Keras fit_generator pulls batches one at a time. Prefetcher keeps up to size batches ready in a queue: worker
+threads take the next raw batch (e.g. from PackedData.batches, reading memory-mapped arrays), apply the per-batch
+transform (one-hot transcoding, pairing, ...) and queue the result. Only these batches are ever in memory.
+
+Keras reads ahead of the batches it trains on and drops what is left when fit_generator returns, so each call gets
+its own one_epoch() generator: batches are tagged with their epoch, workers only start an epoch once the previous
+one is queued, and a batch read ahead from the next epoch is kept for the next call instead of being lost.
+"""
+import sys
+import threading
+from Queue import Queue, Full
+
+
+class _Error(object):
+    """
+    Exception of a worker thread, queued in place of its batch
+    """
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class Prefetcher(object):
+    """
+    transform(batch) of the batches of each epoch, one epoch per one_epoch() generator
+
+    :param epoch: function returning an iterable of the raw batches of one epoch, called again for each epoch
+    :param transform: function from a raw batch to what fit_generator takes, run in the worker threads
+    :param workers: number of worker threads. Batches of an epoch come out of order when there are several
+    :param size: max number of batches ready in the queue
+    """
+
+    def __init__(self, epoch, transform, workers=2, size=8):
+        self.epoch = epoch
+        self.transform = transform
+        self.queue = Queue(size)
+        self.lock = threading.Lock()
+        # signaled when a batch is queued, for the workers waiting to start the next epoch
+        self.queued = threading.Condition(self.lock)
+        self.batches = iter(epoch())
+        self.number = 0
+        self.pending = 0
+        # consumer side: next epoch to hand out, and a batch of a later epoch read by an earlier generator
+        self.consumer = threading.Lock()
+        self.consumed = 0
+        self.held = None
+        self.stopped = threading.Event()
+        self.threads = [threading.Thread(target=self._work) for _ in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _next_batch(self):
+        """
+        :return: (epoch number, raw batch)
+        """
+        with self.lock:
+            try:
+                batch = next(self.batches)
+            except StopIteration:
+                # epochs never interleave in the queue: wait for the batches of this one being transformed
+                while self.pending and not self.stopped.is_set():
+                    self.queued.wait(0.1)
+                self.number += 1
+                self.batches = iter(self.epoch())
+                batch = next(self.batches)
+            self.pending += 1
+            return self.number, batch
+
+    def _put(self, item):
+        """
+        :return: whether the item was queued, False once the prefetcher is closed
+        """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _work(self):
+        while not self.stopped.is_set():
+            try:
+                number, batch = self._next_batch()
+            except Exception:
+                # raised again by one_epoch(), in the training thread
+                self._put(_Error(sys.exc_info()))
+                return
+            try:
+                item = (number, self.transform(batch))
+            except Exception:
+                item = _Error(sys.exc_info())
+            self._put(item)
+            with self.lock:
+                self.pending -= 1
+                self.queued.notify_all()
+            if isinstance(item, _Error):
+                return
+
+    def _take(self, number):
+        """
+        :return: next transformed batch of epoch number, or None once a batch of a later epoch shows up
+        """
+        with self.consumer:
+            while True:
+                if self.held is not None:
+                    item, self.held = self.held, None
+                else:
+                    item = self.queue.get()
+                if isinstance(item, _Error):
+                    self.stopped.set()
+                    raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+                if item[0] == number:
+                    return item[1]
+                if item[0] > number:
+                    self.held = item
+                    return None
+
+    def one_epoch(self):
+        """
+        Generator for one fit_generator call, over the transformed batches of the next epoch.
+        fit_generator keeps reading ahead after its last batch, so the last batch is then repeated: samples_per_epoch
+        must be the number of samples of an epoch for the repeats to be dropped, not trained on
+        """
+        with self.consumer:
+            number = self.consumed
+            self.consumed += 1
+        last = None
+        while True:
+            batch = self._take(number)
+            if batch is None:
+                break
+            last = batch
+            yield batch
+        while last is not None:
+            yield last
+
+    def close(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,188 @@
+"""
+Build the melody and chord dataset of the MIDI corpus, in memory-mapped shards of packed songs
+
+The melody and chord tracks of midilabel/ are read by a pool of processes, folded to 12 pitch classes and written in
+order to .npy shards of shard_size songs, so that neither the build nor the loading needs the whole dataset in RAM.
+Songs are packed (see packed.py), so a shard takes space for the frames of its songs only, not for max_length.
+A directory of shards holds:
+- melody-<n>.npy, chord-<n>.npy: (nb_frame,) bit-packed frames of the songs of the shard, see packed.py
+- offsets-<n>.npy: (count + 1,) start of each song in the frames
+- key-<n>.npy: (count,) major key each song was transposed from, 0 when not transposed
+- index.json: max_length (songs are cut to), shard_size, the shards with their number of songs and frames,
+  and the melody file of every song
+
+Usage: python utils/shards.py ../dataset/melody ../dataset/shards --workers 8
+"""
+import os
+import json
+import itertools
+import argparse
+import numpy as np
+from multiprocessing import Pool
+from midilabel import load_track, read_chroma
+from key_estimation import estimate_key_histogram, major_key, transpose_frames
+from packed import PackedData, pack_melody, pack_chroma
+
+
+def fold_octaves(roll):
+    """
+    :param roll: (128, T) piano roll
+    :return: (12, T) bool, a pitch class is on when any of its octaves is played
+    """
+    pitches, length = roll.shape
+    padded = np.zeros((-(-pitches // 12) * 12, length), dtype=bool)
+    padded[:pitches] = roll != 0
+    return padded.reshape(-1, 12, length).any(axis=0)
+
+
+def read_chroma_track(path):
+    """
+    :return: (12, T) bool chroma of a track, either CSV or .npz
+    """
+    if path.endswith('.npz'):
+        return read_chroma(path)
+    roll = load_track(path)
+    if roll.size == 0:
+        return np.zeros((12, 0), dtype=bool)
+    return fold_octaves(roll.reshape(128, -1))
+
+
+def read_song(job):
+    """
+    :param job: (melody track path, max_length)
+    :return: (melody, chord) of shape (seq_len, 12), or None if a track is empty
+    """
+    m_path, max_length = job
+    c_path = m_path.replace("/melody/", "/chord/", 1)
+    m = read_chroma_track(m_path)[:, :max_length]
+    c = read_chroma_track(c_path)[:, :max_length]
+    seq_len = min(m.shape[1], c.shape[1])
+    if seq_len == 0:
+        return None
+    return m[:, :seq_len].T, c[:, :seq_len].T
+
+
+def listtracks(melody_dir):
+    paths = []
+    for root, _, files in os.walk(melody_dir):
+        for name in files:
+            if name.endswith('.npz') or name.endswith('.csv'):
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+class ShardWriter(object):
+    """
+    Collects songs and writes them shard_size songs at a time
+    """
+
+    def __init__(self, directory, shard_size, transpose_to_c):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.transpose_to_c = transpose_to_c
+        self.shards = []
+        self.paths = []
+        self.songs = []
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _write(self):
+        n = len(self.shards)
+        lengths = np.array([len(melody) for melody, _ in self.songs], dtype=np.int64)
+        offsets = np.append(0, np.cumsum(lengths))
+        melody = np.concatenate([melody for melody, _ in self.songs]).astype(np.int8)
+        chord = np.concatenate([chord for _, chord in self.songs]).astype(np.int8)
+        key = np.zeros(len(self.songs), dtype=np.int8)
+        if self.transpose_to_c:
+            key = major_key(*estimate_key_histogram(np.add.reduceat(melody + chord, offsets[:-1], axis=0)))
+            shift = np.repeat(key, lengths)
+            melody, chord = transpose_frames(melody, shift), transpose_frames(chord, shift)
+        arrays = {'melody': pack_melody(melody), 'chord': pack_chroma(chord), 'offsets': offsets,
+                  'key': key.astype(np.int8)}
+        names = {name: '%s-%05d.npy' % (name, n) for name in arrays}
+        for name in arrays:
+            np.save(os.path.join(self.directory, names[name]), arrays[name])
+        self.shards.append(dict(names, count=len(self.songs), frames=len(melody)))
+        self.songs = []
+
+    def add(self, path, melody, chord):
+        self.songs.append((melody, chord))
+        self.paths.append(path)
+        if len(self.songs) == self.shard_size:
+            self._write()
+
+    def close(self, max_length):
+        if self.songs:
+            self._write()
+        index = {'max_length': max_length, 'shard_size': self.shard_size, 'transpose_to_c': self.transpose_to_c,
+                 'shards': self.shards, 'paths': self.paths}
+        path = os.path.join(self.directory, 'index.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.rename(path + '.tmp', path)
+
+
+def build_shards(melody_dir, directory, max_length=1024, shard_size=4096, workers=1, transpose_to_c=True):
+    """
+    Read every melody track of melody_dir and its chord track, and write them to shards in directory
+
+    :return: number of songs
+    """
+    jobs = [(path, max_length) for path in listtracks(melody_dir)]
+    if workers > 1:
+        pool = Pool(workers)
+        songs = pool.imap(read_song, jobs, chunksize=16)
+    else:
+        pool = None
+        songs = (read_song(job) for job in jobs)
+    writer = ShardWriter(directory, shard_size, transpose_to_c)
+    for (path, _), song in itertools.izip(jobs, songs):
+        if song is not None:
+            writer.add(path, *song)
+    writer.close(max_length)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return len(writer.paths)
+
+
+def load_shard(directory, shard):
+    """
+    :param shard: entry of index.json
+    :return: (data, key) of the songs of a shard, memory-mapped
+    """
+    arrays = {name: np.load(os.path.join(directory, shard[name]), mmap_mode='r')
+              for name in ('melody', 'chord', 'offsets', 'key')}
+    return PackedData(arrays['melody'], arrays['chord'], arrays['offsets']), arrays['key']
+
+
+def load_shards(directory):
+    """
+    :return: (index, data, key). data is the PackedData of all songs and key the major key each song was
+             transposed from. The frames stay memory-mapped, shard by shard, see packed.FrameParts
+    """
+    with open(os.path.join(directory, 'index.json')) as f:
+        index = json.load(f)
+    shards = [load_shard(directory, shard) for shard in index['shards']]
+    if len(shards) == 1:
+        return index, shards[0][0], shards[0][1]
+    if not shards:
+        return index, PackedData(np.zeros(0, np.int8), np.zeros(0, np.uint16), [0]), np.zeros(0, np.int8)
+    # the offsets and keys, one per song, are small enough to join in memory
+    return (index, PackedData.concatenate([data for data, _ in shards], copy=False),
+            np.concatenate([key for _, key in shards]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build memory-mapped dataset shards from midilabel/ tracks')
+    parser.add_argument('melody_dir', help='Directory of the melody tracks, next to the chord tracks')
+    parser.add_argument('directory', help='Output directory of the shards')
+    parser.add_argument('--max_length', type=int, default=1024, help='Default = 1024')
+    parser.add_argument('--shard_size', type=int, default=4096, help='Songs per shard. Default = 4096')
+    parser.add_argument('--workers', type=int, default=1, help='Number of reading processes. Default = 1')
+    parser.add_argument('--no_transpose', dest='transpose_to_c', action='store_false',
+                        help='Keep the songs in their key instead of transposing them to C major')
+    args = parser.parse_args()
+    n = build_shards(args.melody_dir, args.directory, args.max_length, args.shard_size, args.workers,
+                     args.transpose_to_c)
+    print "Wrote %d songs to %s" % (n, args.directory)